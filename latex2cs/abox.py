@@ -5,14 +5,70 @@ AnswerBox for catsoop output generation
 import re
 import os
 import sys
-import hashlib
+import functools
 import traceback
+from concurrent.futures import ProcessPoolExecutor
 from latex2edx.abox import split_args_with_quoted_strings
 
+@functools.lru_cache(maxsize=4096)
+def _cached_split(s):
+    '''
+    Memoized split_args_with_quoted_strings, since identical abox strings
+    recur often (e.g. for templated problems); returns an immutable tuple.
+    '''
+    return tuple(split_args_with_quoted_strings(s))
+
+def _rtq(x):
+    '''
+    Format x as a raw triple-quoted python string literal, as used for generated
+    csq_ assignments; fall back to an escaped repr literal when the content cannot
+    sit inside r"""...""" (embedded triple quote, or trailing quote/backslash).
+    '''
+    if '"""' in x or x.endswith('"') or x.endswith('\\'):
+        return repr(x)
+    return 'r"""%s"""' % x
+
+# tokenizer for comma-delimited option lists: quoted strings or bare (comma-free) text
+_QUOTED_CSV = re.compile(r'"([^"]*)"|\'([^\']*)\'|([^,]+)')
+
+# translation table normalizing unicode characters in abox arguments (e.g. right single quote)
+_NORMALIZE_TABLE = str.maketrans({'\u2019': "'"})
+
+# dispatch table mapping abtype to (question wrapper attribute, maker method)
+_QUESTION_DISPATCH = {'pythonic': ('pythonic', lambda self: self.make_pythonic()),
+                      'multiplechoice': ('multiplechoice', lambda self: self.make_multiplechoice()),
+                      'bigbox': ('bigbox', lambda self: self.make_bigbox()),
+                      'dropdown': ('multiplechoice', lambda self: self.make_multiplechoice("dropdown")),
+}
+
+# map from abox type argument to catsoop question response type; None means un-implemented
+_TYPE2RESPONSE = {'custom': 'pythonic',
+                  'simple': 'pythonic',
+                  'mapcfn': 'mapcfn',	# special for saving global mapping cfn from old_cfn
+                  'external': None,
+                  'code': None,
+                  'oldmultichoice': None,
+                  'multichoice': "multiplechoice",
+                  'numerical': None,
+                  'option': "dropdown",
+                  'formula': None,
+                  'shortans': "bigbox",
+                  'shortanswer': None,
+                  'string': None,
+                  'symbolic': None,
+                  'image': None,
+                  'multicode': None,
+                  'multiexternal': None,
+                  'jsinput': None,
+                  'config': 'config',	# special for setting default config parameters
+}
+
 class AnswerBox:
     '''
     Convert latex specification of student-input answer box, into catsoop question code.
     '''
+    __slots__ = ('aboxstr', 'verbose', 'config', 'context', 'xmlstr_just_code', 'xmlstr', 'abargs', 'tests')
+
     CFN_MAP = {}
     DEFAULT_NPOINTS = 0
 
@@ -34,40 +90,15 @@ class AnswerBox:
         '''
         Convert tex abox code into XML string for catsoop 
         '''
-        if aboxstr.startswith('abox '): aboxstr = aboxstr[5:]
+        aboxstr = aboxstr.removeprefix('abox ')
         s = aboxstr
         s = s.replace(' in_check= ', ' ')
 
-        # unique ID for this abox, using hash
-        try:
-            aboxid = hashlib.sha1(aboxstr).hexdigest()[:10]
-        except Exception as err:
-            aboxid = hashlib.sha1(aboxstr.encode('utf8')).hexdigest()[:10]
-
         # parse answer box arguments into dict
         abargs = self.abox_args(s)
         self.abargs = abargs
 
-        type2response = {'custom': 'pythonic',
-                         'simple': 'pythonic',
-                         'mapcfn': 'mapcfn',	# special for saving global mapping cfn from old_cfn
-                         'external': None,
-                         'code': None,
-                         'oldmultichoice': None,
-                         'multichoice': "multiplechoice",
-                         'numerical': None,
-                         'option': "dropdown",
-                         'formula': None,
-                         'shortans': "bigbox",
-                         'shortanswer': None,
-                         'string': None,
-                         'symbolic': None,
-                         'image': None,
-                         'multicode': None,
-                         'multiexternal': None,
-                         'jsinput': None,
-                         'config': 'config',	# special for setting default config parameters
-        }
+        type2response = _TYPE2RESPONSE
 
         if 'type' in abargs and abargs['type'] in type2response:
             abtype = type2response[abargs['type']]
@@ -75,33 +106,13 @@ class AnswerBox:
             msg = "[latex2cs.abox] Error!  missing type declaration in abox: %s" % aboxstr
             raise Exception(msg)
         
-        if abtype=="pythonic":
-            xs = ['<question pythonic="1">']	# the ="1" is needed for XML format compliance; this is removed later in filter_fix_question
-            #xs += ['<![CDATA[']
-            xs += self.make_pythonic()
-            #xs += ["]]>"]
-            xs += ["</question>"]
-            return "\n".join(xs)
-
-        elif abtype=="multiplechoice":
-            xs = ['<question multiplechoice="1">']
-            xs += self.make_multiplechoice()
-            xs += ["</question>"]
-            return "\n".join(xs)
-
-        elif abtype=="bigbox":
-            xs = ['<question bigbox="1">']
-            xs += self.make_bigbox()
-            xs += ["</question>"]
-            return "\n".join(xs)
-
-        elif abtype=="dropdown":
-            xs = ['<question multiplechoice="1">']
-            xs += self.make_multiplechoice("dropdown")
-            xs += ["</question>"]
-            return "\n".join(xs)
-
-        elif abtype is None:
+        entry = _QUESTION_DISPATCH.get(abtype)
+        if entry is not None:
+            wrapper, make = entry
+            # the ="1" is needed for XML format compliance; this is removed later in filter_fix_question
+            return f'<question {wrapper}="1">\n{make(self)}\n</question>'
+
+        if abtype is None:
             print("[latex2cs.abox] Warning!  Un-implemented abox type %s in %s" % (abargs['type'], aboxstr))
             return
 
@@ -128,12 +139,12 @@ class AnswerBox:
                 val = filter_fun(val)
             except Exception as err:
                 raise Exception("[latex2cs.abox] cannot filter attribute %s by %s, err=%s, abox=%s" % (name, filter_fun, err, self.aboxstr))
-        xs.append('csq_%s = %r' % (newname, val))
+        xs.append(f'csq_{newname} = {val!r}')
 
     def make_bigbox(self):
         '''
         Make a 'bigbox' answer box -- for open text response (ungraded)
-        Return list of lines
+        Return question code as a single string
         '''
         xs = []
         abargs = self.abargs
@@ -141,8 +152,8 @@ class AnswerBox:
         # construct check function
         if 'cfn' in abargs:
             cfn = self.stripquotes(abargs['cfn'])
-            if cfn in AnswerBox.CFN_MAP:
-                ncfn = AnswerBox.CFN_MAP[cfn]
+            ncfn = AnswerBox.CFN_MAP.get(cfn)	# single hash lookup
+            if ncfn is not None:
                 if self.verbose:
                     print("[latex2cs.abox] mapping old cfn=%s -> %s in abox=%s" % (cfn, ncfn, self.aboxstr))
                 cfn = ncfn
@@ -165,23 +176,24 @@ class AnswerBox:
             if nattempts is not None:
                 xs.append("csq_nsubmits = %d" % nattempts)
 
-        return xs
+        return "\n".join(xs)
 
     def make_pythonic(self):
         '''
         Make a 'pythonic' answer box
 
-        Return list of lines
+        Return question code as a single string
         '''
         xs = []
         abargs = self.abargs
+        g = abargs.get		# local bind, to skip repeated attribute lookups
         self.require_args(['expect'])
 
         # construct check function
         if 'cfn' in abargs:
             cfn = self.stripquotes(abargs['cfn'])
-            if cfn in AnswerBox.CFN_MAP:
-                ncfn = AnswerBox.CFN_MAP[cfn]
+            ncfn = AnswerBox.CFN_MAP.get(cfn)	# single hash lookup
+            if ncfn is not None:
                 if self.verbose:
                     print("[latex2cs.abox] mapping old cfn=%s -> %s in abox=%s" % (cfn, ncfn, self.aboxstr))
                 cfn = ncfn
@@ -198,10 +210,10 @@ class AnswerBox:
 
             xs.append("csq_check_function = %s" % cfn)
 
-        self.copy_attrib(xs, 'inline')
-        self.copy_attrib(xs, 'expect', None, "soln")
-        # self.copy_attrib(xs, 'options', {})
-        self.copy_attrib(xs, 'npoints', AnswerBox.DEFAULT_NPOINTS)
+        # batch-format the unconditional csq_ assignments as one block
+        xs.append(f"csq_inline = {g('inline')!r}\n"
+                  f"csq_soln = {g('expect')!r}\n"
+                  f"csq_npoints = {g('npoints', AnswerBox.DEFAULT_NPOINTS)!r}")
         self.copy_attrib(xs, 'rows', None, "rows", skip_if_empty=True, filter_fun=int)
         self.copy_attrib(xs, 'cols', None, "cols", skip_if_empty=True, filter_fun=int)
         self.copy_attrib(xs, 'size', None, "size", skip_if_empty=True)
@@ -230,12 +242,12 @@ class AnswerBox:
             prompts = ['']
         if not len(prompts) == len(answers):
             msg = "Error: number of answers and prompts must match in:"
-            msg += aboxstr
+            msg += self.aboxstr
             msg += "\nabox located: %s\n" % self.context
             raise Exception(msg)
         
-        xs.append("csq_prompts = [%s]" % ", ".join([ self.quoteit(x) for x in prompts ]))
-        xs.append("csq_solns = [%s]" % ", ".join([ self.quoteit(x) for x in answers ]))
+        xs.append("csq_prompts = [%s]" % ", ".join(map(_rtq, prompts)))
+        xs.append("csq_solns = [%s]" % ", ".join(map(_rtq, answers)))
 
         if 'hints' in abargs:
             hname = self.stripquotes(abargs['hints'])
@@ -244,11 +256,12 @@ class AnswerBox:
             xs.append("hs = general_hint_system.HintSystem(hints=%s)" % hname)
             xs.append("csq_check_function = hs.catsoop_check_hint(csq_check_function)")
 
-        return xs
+        return "\n".join(xs)
 
     def make_multiplechoice(self, renderer="checkbox"):
         '''
         Make a 'multiplechoice' answer box
+        Return question code as a single string
         '''
         xs = []
         abargs = self.abargs
@@ -264,7 +277,8 @@ class AnswerBox:
         # expect = self.stripquotes(abargs['expect'])
         expectstr, expect = self.get_options(abargs, 'expect')	# allow for expect to be a list of quoted strings
         if renderer=="checkbox":
-            soln = [(x in expect) for x in options]
+            expect_set = set(expect)	# hashed membership, instead of O(n*m) list scans
+            soln = [(x in expect_set) for x in options]
             xs.append("csq_soln = [%s]" % ", ".join(map(str, soln)))
         else:
             xs.append('csq_soln = r"""%s"""' % expect[0])
@@ -277,23 +291,21 @@ class AnswerBox:
                 nattempts = None
             if nattempts is not None:
                 xs.append("csq_nsubmits = %d" % nattempts)
-        return xs
+        return "\n".join(xs)
 
 
     def quoteit(self, x):
-        return 'r"""%s"""' % x
+        return _rtq(x)
 
     def get_options(self, abargs, arg='options'):
         optstr = abargs[arg]			# should be double quoted strings, comma delimited
-        # EVH 01-22-2015: Inserting quotes around single option for proper
-        # parsing of choices containing commas
+        # EVH 01-22-2015: an unquoted string is a single option, so that
+        # choices containing commas are preserved
         if not optstr.startswith('"') and not optstr.startswith("'"):
-            optraw = repr(optstr)
-            optstr = optraw[0] + optstr + optraw[0]
-        options = split_args_with_quoted_strings(optstr, lambda x: x == ',')		# turn into list of strings
-        options = list(map(self.stripquotes, options))
-        options = [x.strip() for x in options]		# strip strings
-        if "" in options: options.remove("")
+            options = [optstr]
+        else:
+            options = [(a or b or c) for (a, b, c) in _QUOTED_CSV.findall(optstr)]	# turn into list of unquoted strings
+        options = [x for x in (x.strip() for x in options) if x]	# strip strings, dropping any empties
         optionstr = ','.join([r"'%s'" % x for x in options])  # string of single quoted strings
         optionstr = "(%s)" % optionstr				# enclose in parens
         return optionstr, options
@@ -317,46 +329,61 @@ class AnswerBox:
         Arguments with those keys are stored in self.tests ; they may be used
         by the caller to construct answer box unit tests and course unit tests.
         '''
-        s = s.replace('\u2019', "'")
-        try:
-            s = str(s)
-        except Exception as err:
-            print("Error %s in obtaining string form of abox argument %s" % (err, s))
-            return {}
+        s = s.translate(_NORMALIZE_TABLE)
         try:
             # abargstxt = shlex.split(s)
-            abargstxt = split_args_with_quoted_strings(s)
+            abargstxt = _cached_split(s)
         except Exception as err:
             print("Error %s in parsing abox argument %s" % (err, s))
             return {}
 
-        if '' in abargstxt:
-            abargstxt.remove('')
-
         abargs = {}
         try:
-            for key, val in [x.split('=', 1) for x in abargstxt]:
+            for tok in abargstxt:
+                if not tok:
+                    continue
+                key, sep, val = tok.partition('=')
+                if not sep:
+                    raise ValueError("missing '=' in abox argument %r" % tok)
                 if key.startswith("test_"):
                     self.process_test_arg(key, val)
                 else:
-                    abargs[key] = val
-        except Exception as err:
+                    abargs[key] = self.stripquotes(val, checkinternal=True)
+        except ValueError as err:
             print("Error %s" % err)
             print("Failed in parsing args = %s" % s)
-            print("abargstxt = %s" % abargstxt)
+            print("abargstxt = %s" % (abargstxt,))
             raise
 
-        for arg in abargs:
-            abargs[arg] = self.stripquotes(abargs[arg], checkinternal=True)
-
         return abargs
 
     def stripquotes(self, x, checkinternal=False):
-        if x.startswith('"') and x.endswith('"'):
-            if checkinternal and '"' in x[1:-1]:
-                return x
-            return x[1:-1]
-        if x.startswith("'") and x.endswith("'"):
-            return x[1:-1]
+        if len(x) >= 2:
+            c = x[0]
+            if c == x[-1] and c in ('"', "'"):
+                if checkinternal and c == '"' and '"' in x[1:-1]:
+                    return x
+                return x[1:-1]
         return x
+
+def _abox_worker(args):
+    '''
+    Worker for process_many: construct an AnswerBox from an argument tuple and return its xmlstr.
+    '''
+    return AnswerBox(*args).xmlstr
+
+def process_many(items, workers=None):
+    '''
+    Compile many aboxes in parallel, using a process pool; each abox construction is
+    independent, so this is embarrassingly parallel.
+
+    items   = list of (aboxstr, config, context) argument tuples
+    workers = number of worker processes (default: one per CPU)
+
+    Returns list of xmlstr, in input order.  Note that CFN_MAP updates made by
+    mapcfn aboxes happen in the worker processes, so batches relying on a cfn
+    mapping should set it up before calling this.
+    '''
+    with ProcessPoolExecutor(workers) as ex:
+        return list(ex.map(_abox_worker, items, chunksize=32))
             
@@ -1,27 +1,73 @@
 """
 Parser and evaluator for FormulaResponse and NumericalResponse
 
-Uses pyparsing to parse. Main function as of now is evaluator().
+Uses a hand-written recursive-descent parser. Main function as of now is
+evaluator().
 """
 
+import ast
+import cmath
 import math
-import operator
-import numbers
 import numpy
+import re
 import scipy.constants
+import scipy.special
 
-from pyparsing import (
-    Word, Literal, CaselessLiteral, ZeroOrMore, MatchFirst, Optional, Forward,
-    Group, ParseResults, stringEnd, Suppress, Combine, alphas, nums, alphanums
-)
-from functools import reduce
+from functools import lru_cache
+
+
+def _scalar(math_fn, cmath_fn, on_zero=None):
+    """
+    Combine math/cmath counterparts into one scalar function.
+
+    The evaluator only ever passes Python scalars, for which `math.*` is an
+    order of magnitude faster than the equivalent numpy ufunc (which pays
+    dispatch and 0-d array overhead per call). Complex arguments go to the
+    `cmath` variant; real arguments outside the domain give NaN, and results
+    too large for a float give the signed infinity, as the ufuncs did.
+    `on_zero` is the value returned at zero for functions with a pole there
+    (the logs return -inf, matching numpy).
+    """
+    def scalar_fn(arg):
+        if isinstance(arg, complex):
+            return cmath_fn(arg)
+        try:
+            return math_fn(arg)
+        except OverflowError:
+            # overflow to the infinity the function approaches for this sign
+            # of argument (exp/cosh -> +inf, sinh follows the argument)
+            return math.copysign(float('inf'), math_fn(math.copysign(1.0, arg)))
+        except ValueError:
+            if on_zero is not None and arg == 0:
+                return on_zero
+            return float('nan')
+    return scalar_fn
+
+
+_sin = _scalar(math.sin, cmath.sin)
+_cos = _scalar(math.cos, cmath.cos)
+_tan = _scalar(math.tan, cmath.tan)
+_sqrt = _scalar(math.sqrt, cmath.sqrt)
+_log10 = _scalar(math.log10, cmath.log10, on_zero=float('-inf'))
+_log2 = _scalar(math.log2, lambda z: cmath.log(z) / math.log(2), on_zero=float('-inf'))
+_ln = _scalar(math.log, cmath.log, on_zero=float('-inf'))
+_exp = _scalar(math.exp, cmath.exp)
+_arccos = _scalar(math.acos, cmath.acos)
+_arcsin = _scalar(math.asin, cmath.asin)
+_arctan = _scalar(math.atan, cmath.atan)
+_sinh = _scalar(math.sinh, cmath.sinh)
+_cosh = _scalar(math.cosh, cmath.cosh)
+_tanh = _scalar(math.tanh, cmath.tanh)
+_arcsinh = _scalar(math.asinh, cmath.asinh)
+_arccosh = _scalar(math.acosh, cmath.acosh)
+_arctanh = _scalar(math.atanh, cmath.atanh)
 
 
 #-----------------------------------------------------------------------------
 
 class functions:
     """
-    Provide the mathematical functions that numpy doesn't.
+    Provide the mathematical functions that math/cmath don't.
     
     Specifically, the secant/cosecant/cotangents and their inverses and
     hyperbolic counterparts
@@ -33,7 +79,7 @@ class functions:
         """
         Secant
         """
-        return 1 / numpy.cos(arg)
+        return 1 / _cos(arg)
     
     
     @staticmethod
@@ -41,7 +87,7 @@ class functions:
         """
         Cosecant
         """
-        return 1 / numpy.sin(arg)
+        return 1 / _sin(arg)
     
     
     @staticmethod
@@ -49,7 +95,7 @@ class functions:
         """
         Cotangent
         """
-        return 1 / numpy.tan(arg)
+        return 1 / _tan(arg)
     
     
     # Inverse Trig
@@ -59,7 +105,7 @@ class functions:
         """
         Inverse secant
         """
-        return numpy.arccos(1. / val)
+        return _arccos(1. / val)
     
     
     @staticmethod
@@ -67,7 +113,7 @@ class functions:
         """
         Inverse cosecant
         """
-        return numpy.arcsin(1. / val)
+        return _arcsin(1. / val)
     
     
     @staticmethod
@@ -75,10 +121,10 @@ class functions:
         """
         Inverse cotangent
         """
-        if numpy.real(val) < 0:
-            return -numpy.pi / 2 - numpy.arctan(val)
+        if val.real < 0:
+            return -math.pi / 2 - _arctan(val)
         else:
-            return numpy.pi / 2 - numpy.arctan(val)
+            return math.pi / 2 - _arctan(val)
     
     
     # Hyperbolic Trig
@@ -87,7 +133,7 @@ class functions:
         """
         Hyperbolic secant
         """
-        return 1 / numpy.cosh(arg)
+        return 1 / _cosh(arg)
     
     
     @staticmethod
@@ -95,7 +141,7 @@ class functions:
         """
         Hyperbolic cosecant
         """
-        return 1 / numpy.sinh(arg)
+        return 1 / _sinh(arg)
     
     
     @staticmethod
@@ -103,7 +149,7 @@ class functions:
         """
         Hyperbolic cotangent
         """
-        return 1 / numpy.tanh(arg)
+        return 1 / _tanh(arg)
     
     
     # And their inverses
@@ -112,7 +158,7 @@ class functions:
         """
         Inverse hyperbolic secant
         """
-        return numpy.arccosh(1. / val)
+        return _arccosh(1. / val)
     
     
     @staticmethod
@@ -120,7 +166,7 @@ class functions:
         """
         Inverse hyperbolic cosecant
         """
-        return numpy.arcsinh(1. / val)
+        return _arcsinh(1. / val)
     
     
     @staticmethod
@@ -128,47 +174,47 @@ class functions:
         """
         Inverse hyperbolic cotangent
         """
-        return numpy.arctanh(1. / val)
+        return _arctanh(1. / val)
 
 #-----------------------------------------------------------------------------
 
 DEFAULT_FUNCTIONS = {
-    'sin': numpy.sin,
-    'cos': numpy.cos,
-    'tan': numpy.tan,
+    'sin': _sin,
+    'cos': _cos,
+    'tan': _tan,
     'sec': functions.sec,
     'csc': functions.csc,
     'cot': functions.cot,
-    'sqrt': numpy.sqrt,
-    'log10': numpy.log10,
-    'log2': numpy.log2,
-    'ln': numpy.log,
-    'exp': numpy.exp,
-    'arccos': numpy.arccos,
-    'arcsin': numpy.arcsin,
-    'arctan': numpy.arctan,
+    'sqrt': _sqrt,
+    'log10': _log10,
+    'log2': _log2,
+    'ln': _ln,
+    'exp': _exp,
+    'arccos': _arccos,
+    'arcsin': _arcsin,
+    'arctan': _arctan,
     'arcsec': functions.arcsec,
     'arccsc': functions.arccsc,
     'arccot': functions.arccot,
-    'abs': numpy.abs,
+    'abs': abs,
     'fact': math.factorial,
     'factorial': math.factorial,
-    'sinh': numpy.sinh,
-    'cosh': numpy.cosh,
-    'tanh': numpy.tanh,
+    'sinh': _sinh,
+    'cosh': _cosh,
+    'tanh': _tanh,
     'sech': functions.sech,
     'csch': functions.csch,
     'coth': functions.coth,
-    'arcsinh': numpy.arcsinh,
-    'arccosh': numpy.arccosh,
-    'arctanh': numpy.arctanh,
+    'arcsinh': _arcsinh,
+    'arccosh': _arccosh,
+    'arctanh': _arctanh,
     'arcsech': functions.arcsech,
     'arccsch': functions.arccsch,
     'arccoth': functions.arccoth
 }
 DEFAULT_VARIABLES = {
-    'i': numpy.complex(0, 1),
-    'j': numpy.complex(0, 1),
+    'i': 1j,
+    'j': 1j,
     'e': numpy.e,
     'pi': numpy.pi,
     'k': scipy.constants.k,  # Boltzmann: 1.3806488e-23 (Joules/Kelvin)
@@ -196,6 +242,13 @@ class UndefinedVariable(Exception):
     pass
 
 
+class ParseError(Exception):
+    """
+    Indicate when a math expression cannot be parsed.
+    """
+    pass
+
+
 def lower_dict(input_dict):
     """
     Convert all keys in a dictionary to lowercase; keep their original values.
@@ -207,6 +260,12 @@ def lower_dict(input_dict):
     return {k.lower(): v for k, v in input_dict.items()}
 
 
+# The default dicts never change; precompute their lowercase variants so
+# add_defaults needn't re-lower ~40 keys on every evaluator call.
+DEFAULT_VARIABLES_LOWER = lower_dict(DEFAULT_VARIABLES)
+DEFAULT_FUNCTIONS_LOWER = lower_dict(DEFAULT_FUNCTIONS)
+
+
 # The following few functions define evaluation actions, which are run on lists
 # of results from each parse component. They convert the strings and (previously
 # calculated) numbers into the number that component represents.
@@ -215,10 +274,14 @@ def super_float(text):
     """
     Like float, but with SI extensions. 1k goes to 1000.
     """
-    if text[-1] in SUFFIXES:
-        return float(text[:-1]) * SUFFIXES[text[-1]]
-    else:
+    last = text[-1]
+    if last.isdigit() or last == '.':
+        # Overwhelmingly the common case: no suffix.
         return float(text)
+    multiple = SUFFIXES.get(last)
+    if multiple is not None:
+        return float(text[:-1]) * multiple
+    return float(text)
 
 
 def eval_number(parse_result):
@@ -237,9 +300,9 @@ def eval_atom(parse_result):
 
     In the case of parenthesis, ignore them.
     """
-    # Find first number in the list
-    result = next(k for k in parse_result if isinstance(k, numbers.Number))
-    return result
+    # The grammar guarantees the value is either the only child or, for a
+    # parenthesized expression, right after the '('.
+    return parse_result[1] if parse_result[0] == '(' else parse_result[0]
 
 
 def eval_power(parse_result):
@@ -249,13 +312,19 @@ def eval_power(parse_result):
     e.g. [ 2, 3, 2 ] -> 2^3^2 = 2^(3^2) -> 512
     (not to be interpreted (2^3)^2 = 64)
     """
-    # `reduce` will go from left to right; reverse the list.
-    parse_result = reversed(
-        [k for k in parse_result
-         if isinstance(k, numbers.Number)]  # Ignore the '^' marks.
-    )
-    # Having reversed it, raise `b` to the power of `a`.
-    power = reduce(lambda a, b: b ** a, parse_result)
+    nums = [k for k in parse_result
+            if not isinstance(k, str)]  # Ignore the '^' marks.
+    # Exponentiation is right-associative; accumulate from the right.
+    power = nums[-1]
+    for base in reversed(nums[:-1]):
+        if power == 2:
+            power = base * base
+        elif power == 3:
+            power = base * base * base
+        elif power == 0.5 and not isinstance(base, complex) and base >= 0:
+            power = math.sqrt(base)
+        else:
+            power = base ** power
     return power
 
 
@@ -271,11 +340,14 @@ def eval_parallel(parse_result):
     """
     if len(parse_result) == 1:
         return parse_result[0]
-    if 0 in parse_result:
-        return float('nan')
-    reciprocals = [1. / e for e in parse_result
-                   if isinstance(e, numbers.Number)]
-    return 1. / sum(reciprocals)
+    total = 0.
+    for entry in parse_result:
+        if isinstance(entry, str):
+            continue  # Ignore the '||' marks.
+        if entry == 0:
+            return float('nan')
+        total += 1. / entry
+    return 1. / total
 
 
 def eval_sum(parse_result):
@@ -286,16 +358,21 @@ def eval_sum(parse_result):
 
     Allow a leading + or -.
     """
-    total = 0.0
-    current_op = operator.add
+    signed = []
+    negate = False
     for token in parse_result:
         if token == '+':
-            current_op = operator.add
+            negate = False
         elif token == '-':
-            current_op = operator.sub
+            negate = True
         else:
-            total = current_op(total, token)
-    return total
+            signed.append(-token if negate else token)
+    try:
+        # Numerically-stable summation.
+        return math.fsum(signed)
+    except TypeError:
+        # fsum only handles floats; fall back for complex values.
+        return 0.0 + sum(signed)
 
 
 def eval_product(parse_result):
@@ -305,31 +382,152 @@ def eval_product(parse_result):
     [ 1, '*', 2, '/', 3 ] -> 0.66
     """
     prod = 1.0
-    current_op = operator.mul
+    divide = False
     for token in parse_result:
         if token == '*':
-            current_op = operator.mul
+            divide = False
         elif token == '/':
-            current_op = operator.truediv
+            divide = True
+        elif divide:
+            prod /= token
         else:
-            prod = current_op(prod, token)
+            prod *= token
     return prod
 
 
-def add_defaults(variables, functions, case_sensitive):
+# Evaluation compiles the parse tree to a Python code object once per
+# expression (cached), then runs it with a plain `eval` and a globals dict of
+# variable values. CPython's eval loop is far tighter than recursively
+# dispatching through the eval_* actions above, which still define the
+# semantics the lowering mirrors.
+
+# Functions share the eval globals with variables; prefix their names so a
+# variable and a function with the same name cannot collide.
+_FN_PREFIX = '_fn_'
+
+
+def _parallel(*operands):
     """
-    Create dictionaries with both the default and user-defined variables.
+    Runtime helper for the `||` operator; defers to `eval_parallel`.
     """
-    all_variables = dict(DEFAULT_VARIABLES)
-    all_functions = dict(DEFAULT_FUNCTIONS)
-    all_variables.update(variables)
-    all_functions.update(functions)
+    return eval_parallel(operands)
 
-    if not case_sensitive:
-        all_variables = lower_dict(all_variables)
-        all_functions = lower_dict(all_functions)
 
-    return (all_variables, all_functions)
+def _to_ast(node, casify):
+    """
+    Lower a parse-tree node to the equivalent Python `ast` node.
+
+    Numbers become constants (folded through `super_float`), variables become
+    names (casified so they match the eval globals), `^` becomes `**` and
+    `||` becomes a call to `_parallel`. Sums start from 0.0 and products from
+    1.0, as in `eval_sum`/`eval_product`, so results coerce to float/complex
+    the same way the tree-walking interpreter did.
+    """
+    kind, children = node
+
+    if kind == 'number':
+        return ast.Constant(super_float("".join(children)))
+
+    if kind == 'variable':
+        return ast.Name(casify(children[0]), ast.Load())
+
+    if kind == 'function':
+        return ast.Call(
+            ast.Name(_FN_PREFIX + casify(children[0]), ast.Load()),
+            [_to_ast(children[1], casify)], []
+        )
+
+    if kind == 'atom':
+        # In the case of parenthesis, ignore them.
+        return _to_ast(children[1] if children[0] == '(' else children[0], casify)
+
+    operands = [_to_ast(k, casify) for k in children if not isinstance(k, str)]
+
+    if kind == 'power':
+        # Right-to-left, as in eval_power.
+        result = operands[-1]
+        for base in reversed(operands[:-1]):
+            result = ast.BinOp(base, ast.Pow(), result)
+        return result
+
+    if kind == 'parallel':
+        if len(operands) == 1:
+            return operands[0]
+        return ast.Call(ast.Name('_parallel', ast.Load()), operands, [])
+
+    if kind == 'product':
+        result = ast.Constant(1.0)
+        current_op = ast.Mult
+        operands.reverse()
+        for token in children:
+            if token == '*':
+                current_op = ast.Mult
+            elif token == '/':
+                current_op = ast.Div
+            else:
+                result = ast.BinOp(result, current_op(), operands.pop())
+        return result
+
+    if kind == 'sum':
+        result = ast.Constant(0.0)
+        current_op = ast.Add
+        operands.reverse()
+        for token in children:
+            if token == '+':
+                current_op = ast.Add
+            elif token == '-':
+                current_op = ast.Sub
+            else:
+                result = ast.BinOp(result, current_op(), operands.pop())
+        return result
+
+    raise Exception("Unknown branch name '{}'".format(kind))  # pragma: no cover
+
+
+@lru_cache(maxsize=4096)
+def _parse_cached(math_expr, case_sensitive):
+    """
+    Parse `math_expr`, memoized on the expression string.
+
+    Return the `ParseAugmenter`, which carries the tree and the sets of
+    variable/function names used. Grading workloads evaluate or render the
+    same expression with many different bindings, so the parse is shared.
+    """
+    math_interpreter = ParseAugmenter(math_expr, case_sensitive)
+    math_interpreter.parse_algebra()
+    return math_interpreter
+
+
+@lru_cache(maxsize=4096)
+def _compile_cached(math_expr, case_sensitive):
+    """
+    Parse and compile `math_expr`, memoized on the expression string.
+
+    Return `(math_interpreter, code)` where the interpreter carries the
+    variable/function names used (for `check_variables`) and `code` is ready
+    for `eval` with a globals dict of values.
+    """
+    math_interpreter = _parse_cached(math_expr, case_sensitive)
+
+    if case_sensitive:
+        casify = lambda x: x
+    else:
+        casify = lambda x: x.lower()  # Lowercase for case insens.
+
+    tree = ast.Expression(_to_ast(math_interpreter.tree, casify))
+    code = compile(ast.fix_missing_locations(tree), '<formula>', 'eval')
+    return (math_interpreter, code)
+
+
+def add_defaults(variables, functions, case_sensitive):
+    """
+    Create dictionaries with both the default and user-defined variables.
+    """
+    if case_sensitive:
+        return ({**DEFAULT_VARIABLES, **variables},
+                {**DEFAULT_FUNCTIONS, **functions})
+    return ({**DEFAULT_VARIABLES_LOWER, **lower_dict(variables)},
+            {**DEFAULT_FUNCTIONS_LOWER, **lower_dict(functions)})
 
 
 def evaluator(variables, functions, math_expr, case_sensitive=False):
@@ -344,9 +542,8 @@ def evaluator(variables, functions, math_expr, case_sensitive=False):
     if math_expr.strip() == "":
         return float('nan')
 
-    # Parse the tree.
-    math_interpreter = ParseAugmenter(math_expr, case_sensitive)
-    math_interpreter.parse_algebra()
+    # Parse and compile (memoized).
+    math_interpreter, code = _compile_cached(math_expr, case_sensitive)
 
     # Get our variables together.
     all_variables, all_functions = add_defaults(variables, functions, case_sensitive)
@@ -354,24 +551,276 @@ def evaluator(variables, functions, math_expr, case_sensitive=False):
     # ...and check them
     math_interpreter.check_variables(all_variables, all_functions)
 
-    # Create a recursion to evaluate the tree.
+    # Bind only the names the expression actually uses; the _norm sets are
+    # already casified, so no per-name lowering is needed here.
+    eval_globals = {'__builtins__': {}, '_parallel': _parallel}
+    for var in math_interpreter.variables_used_norm:
+        eval_globals[var] = all_variables[var]
+    for fun in math_interpreter.functions_used_norm:
+        eval_globals[_FN_PREFIX + fun] = all_functions[fun]
+
+    return eval(code, eval_globals)  # pylint: disable=W0123
+
+
+# Vectorized counterparts to DEFAULT_FUNCTIONS, for evaluator_batch: the
+# scalar math/cmath dispatchers above don't broadcast over arrays.
+_BATCH_FUNCTIONS = {
+    'sin': numpy.sin,
+    'cos': numpy.cos,
+    'tan': numpy.tan,
+    'sec': lambda arg: 1 / numpy.cos(arg),
+    'csc': lambda arg: 1 / numpy.sin(arg),
+    'cot': lambda arg: 1 / numpy.tan(arg),
+    'sqrt': numpy.sqrt,
+    'log10': numpy.log10,
+    'log2': numpy.log2,
+    'ln': numpy.log,
+    'exp': numpy.exp,
+    'arccos': numpy.arccos,
+    'arcsin': numpy.arcsin,
+    'arctan': numpy.arctan,
+    'arcsec': lambda val: numpy.arccos(1. / val),
+    'arccsc': lambda val: numpy.arcsin(1. / val),
+    'arccot': lambda val: numpy.where(numpy.real(val) < 0,
+                                      -numpy.pi / 2 - numpy.arctan(val),
+                                      numpy.pi / 2 - numpy.arctan(val)),
+    'abs': numpy.abs,
+    'fact': scipy.special.factorial,
+    'factorial': scipy.special.factorial,
+    'sinh': numpy.sinh,
+    'cosh': numpy.cosh,
+    'tanh': numpy.tanh,
+    'sech': lambda arg: 1 / numpy.cosh(arg),
+    'csch': lambda arg: 1 / numpy.sinh(arg),
+    'coth': lambda arg: 1 / numpy.tanh(arg),
+    'arcsinh': numpy.arcsinh,
+    'arccosh': numpy.arccosh,
+    'arctanh': numpy.arctanh,
+    'arcsech': lambda val: numpy.arccosh(1. / val),
+    'arccsch': lambda val: numpy.arcsinh(1. / val),
+    'arccoth': lambda val: numpy.arctanh(1. / val)
+}
+
+
+def _parallel_batch(*operands):
+    """
+    Array-aware `||`: elementwise 1 / (1/in1 + 1/in2 + ...), NaN where any
+    input is zero.
+    """
+    if len(operands) == 1:
+        return operands[0]
+    arrays = [numpy.asarray(entry) for entry in operands]
+    zero = arrays[0] == 0
+    for arr in arrays[1:]:
+        zero = zero | (arr == 0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        result = 1. / sum(1. / arr for arr in arrays)
+    return numpy.where(zero, float('nan'), result)
+
+
+def evaluator_batch(variables, functions, math_expr, case_sensitive=False):
+    """
+    Like `evaluator`, but evaluate over arrays of variable assignments.
+
+    Variables map names to numpy arrays (broadcastable against each other);
+    the compiled expression is run once with array values, so N assignments
+    cost one vectorized pass instead of N interpreter calls. Returns an
+    array.
+    """
+    # No need to go further.
+    if math_expr.strip() == "":
+        return float('nan')
+
+    # Parse and compile (memoized).
+    math_interpreter, code = _compile_cached(math_expr, case_sensitive)
+
+    # Get our variables together, with vectorized defaults.
     if case_sensitive:
-        casify = lambda x: x
+        all_variables = {**DEFAULT_VARIABLES, **variables}
+        all_functions = {**_BATCH_FUNCTIONS, **functions}
     else:
-        casify = lambda x: x.lower()  # Lowercase for case insens.
+        # _BATCH_FUNCTIONS keys are already all lowercase.
+        all_variables = {**DEFAULT_VARIABLES_LOWER, **lower_dict(variables)}
+        all_functions = {**_BATCH_FUNCTIONS, **lower_dict(functions)}
 
-    evaluate_actions = {
-        'number': eval_number,
-        'variable': lambda x: all_variables[casify(x[0])],
-        'function': lambda x: all_functions[casify(x[0])](x[1]),
-        'atom': eval_atom,
-        'power': eval_power,
-        'parallel': eval_parallel,
-        'product': eval_product,
-        'sum': eval_sum
-    }
+    # ...and check them
+    math_interpreter.check_variables(all_variables, all_functions)
+
+    # Bind only the names the expression actually uses.
+    eval_globals = {'__builtins__': {}, '_parallel': _parallel_batch}
+    for var in math_interpreter.variables_used_norm:
+        eval_globals[var] = all_variables[var]
+    for fun in math_interpreter.functions_used_norm:
+        eval_globals[_FN_PREFIX + fun] = all_functions[fun]
+
+    return eval(code, eval_globals)  # pylint: disable=W0123
+
+
+# One master regex for the hand-written parser below, so tokenization is a
+# single pass through the C regex engine. A number is a mantissa with an
+# optional exponent and an optional SI suffix, e.g. 0.33 or 7 or .34 or 16.
+# or 3.4E-3 or 5k; identifiers start with letters/underscores and may contain
+# numbers afterward.
+_TOKEN_RE = re.compile(
+    r'(?P<mantissa>\d+\.?\d*|\.\d+)(?P<exponent>[eE][+-]?\d+)?(?P<suffix>[{}])?'
+    r'|(?P<ident>[A-Za-z_][A-Za-z0-9_]*)'
+    r'|(?P<op>\|\||[-+*/^()])'
+    r'|(?P<space>[ \t\n]+)'.format(re.escape("".join(SUFFIXES)))
+)
+
+NUMBER, IDENT, OP = 'number', 'ident', 'op'
 
-    return math_interpreter.reduce_tree(evaluate_actions)
+
+def _tokenize(math_expr):
+    """
+    Split `math_expr` into a list of `(kind, value)` tokens.
+
+    Number tokens carry their string parts--mantissa, 'E', exponent sign,
+    exponent, suffix--as a list, matching the shape the evaluation and
+    rendering actions expect (e.g. '3.4e+3k' -> ['3.4', 'E', '+', '3', 'k']).
+    """
+    tokens = []
+    pos = 0
+    end = len(math_expr)
+    while pos < end:
+        match = _TOKEN_RE.match(math_expr, pos)
+        if match is None:
+            raise ParseError(
+                "Invalid character {!r} (at char {})".format(math_expr[pos], pos)
+            )
+        pos = match.end()
+        op = match['op']
+        if op is not None:
+            tokens.append((OP, op))
+            continue
+        ident = match['ident']
+        if ident is not None:
+            tokens.append((IDENT, ident))
+            continue
+        mantissa = match['mantissa']
+        if mantissa is not None:
+            parts = [mantissa]
+            exponent = match['exponent']
+            if exponent:
+                parts.append('E')
+                if exponent[1] in '+-':
+                    parts.append(exponent[1])
+                    parts.append(exponent[2:])
+                else:
+                    parts.append(exponent[1:])
+            suffix = match['suffix']
+            if suffix:
+                parts.append(suffix)
+            tokens.append((NUMBER, parts))
+        # else: whitespace, skip.
+    return tokens
+
+
+def _parse_tree(math_expr, variables_used, functions_used):
+    """
+    Parse `math_expr` into a tree of `(name, children)` tuples.
+
+    The tree has the same nesting the old pyparsing grammar produced: every
+    sum wraps products, which wrap parallels, which wrap powers, which wrap
+    atoms, even for single children. Terminal nodes are plain strings.
+    Variable and function names encountered are added to the given sets.
+    """
+    tokens = _tokenize(math_expr)
+    ntokens = len(tokens)
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < ntokens else (None, None)
+
+    def parse_sum():
+        # -5 + 4 - 3; allow a leading + or -.
+        nonlocal pos
+        children = []
+        kind, value = peek()
+        if kind is OP and value in '+-':
+            children.append(value)
+            pos += 1
+        children.append(parse_product())
+        while True:
+            kind, value = peek()
+            if kind is OP and value in '+-':
+                children.append(value)
+                pos += 1
+                children.append(parse_product())
+            else:
+                return ('sum', children)
+
+    def parse_product():
+        # 7 * 5 / 4
+        nonlocal pos
+        children = [parse_parallel()]
+        while True:
+            kind, value = peek()
+            if kind is OP and value in '*/':
+                children.append(value)
+                pos += 1
+                children.append(parse_parallel())
+            else:
+                return ('product', children)
+
+    def parse_parallel():
+        # 5k || 4k
+        nonlocal pos
+        children = [parse_power()]
+        while peek() == (OP, '||'):
+            children.append('||')
+            pos += 1
+            children.append(parse_power())
+        return ('parallel', children)
+
+    def parse_power():
+        nonlocal pos
+        children = [parse_atom()]
+        while peek() == (OP, '^'):
+            children.append('^')
+            pos += 1
+            children.append(parse_atom())
+        return ('power', children)
+
+    def parse_atom():
+        nonlocal pos
+        kind, value = peek()
+        if kind is NUMBER:
+            pos += 1
+            return ('atom', [('number', value)])
+        if kind is OP and value in '+-' and pos + 1 < ntokens and tokens[pos + 1][0] is NUMBER:
+            # A signed number, e.g. the -5 in 2*-5.
+            pos += 1
+            number = [value] + tokens[pos][1]
+            pos += 1
+            return ('atom', [('number', number)])
+        if kind is IDENT:
+            pos += 1
+            if peek() == (OP, '('):
+                pos += 1
+                inner = parse_sum()
+                if peek() != (OP, ')'):
+                    raise ParseError("Expected ')' (at char {})".format(pos))
+                pos += 1
+                functions_used.add(value)
+                return ('atom', [('function', [value, inner])])
+            variables_used.add(value)
+            return ('atom', [('variable', [value])])
+        if kind is OP and value == '(':
+            pos += 1
+            inner = parse_sum()
+            if peek() != (OP, ')'):
+                raise ParseError("Expected ')' (at char {})".format(pos))
+            pos += 1
+            return ('atom', ['(', inner, ')'])
+        raise ParseError("Unexpected token {!r} (at char {})".format(value, pos))
+
+    tree = parse_sum()
+    if pos != ntokens:
+        raise ParseError(
+            "Expected end of expression, found {!r} (at char {})".format(tokens[pos][1], pos)
+        )
+    return tree
 
 
 class ParseAugmenter(object):
@@ -393,87 +842,28 @@ class ParseAugmenter(object):
         self.tree = None
         self.variables_used = set()
         self.functions_used = set()
-
-        def vpa(tokens):
-            """
-            When a variable is recognized, store it in `variables_used`.
-            """
-            varname = tokens[0][0]
-            self.variables_used.add(varname)
-
-        def fpa(tokens):
-            """
-            When a function is recognized, store it in `functions_used`.
-            """
-            varname = tokens[0][0]
-            self.functions_used.add(varname)
-
-        self.variable_parse_action = vpa
-        self.function_parse_action = fpa
+        # Casified (lowercased unless case sensitive) copies, filled in by
+        # parse_algebra, so callers needn't re-lower names on every use.
+        self.variables_used_norm = set()
+        self.functions_used_norm = set()
 
     def parse_algebra(self):
         """
         Parse an algebraic expression into a tree.
 
-        Store a `pyparsing.ParseResult` in `self.tree` with proper groupings to
-        reflect parenthesis and order of operations. Leave all operators in the
-        tree and do not parse any strings of numbers into their float versions.
-
-        Adding the groups and result names makes the `repr()` of the result
-        really gross. For debugging, use something like
-          print OBJ.tree.asXML()
-        """
-        # 0.33 or 7 or .34 or 16.
-        number_part = Word(nums)
-        inner_number = (number_part + Optional("." + Optional(number_part))) | ("." + number_part)
-        # pyparsing allows spaces between tokens--`Combine` prevents that.
-        inner_number = Combine(inner_number)
-
-        # SI suffixes and percent.
-        number_suffix = MatchFirst(Literal(k) for k in list(SUFFIXES.keys()))
-
-        # 0.33k or 17
-        plus_minus = Literal('+') | Literal('-')
-        number = Group(
-            Optional(plus_minus) +
-            inner_number +
-            Optional(CaselessLiteral("E") + Optional(plus_minus) + number_part) +
-            Optional(number_suffix)
-        )
-        number = number("number")
-
-        # Predefine recursive variables.
-        expr = Forward()
-
-        # Handle variables passed in. They must start with letters/underscores
-        # and may contain numbers afterward.
-        inner_varname = Word(alphas + "_", alphanums + "_")
-        varname = Group(inner_varname)("variable")
-        varname.setParseAction(self.variable_parse_action)
-
-        # Same thing for functions.
-        function = Group(inner_varname + Suppress("(") + expr + Suppress(")"))("function")
-        function.setParseAction(self.function_parse_action)
-
-        atom = number | function | varname | "(" + expr + ")"
-        atom = Group(atom)("atom")
-
-        # Do the following in the correct order to preserve order of operation.
-        pow_term = atom + ZeroOrMore("^" + atom)
-        pow_term = Group(pow_term)("power")
-
-        par_term = pow_term + ZeroOrMore('||' + pow_term)  # 5k || 4k
-        par_term = Group(par_term)("parallel")
-
-        prod_term = par_term + ZeroOrMore((Literal('*') | Literal('/')) + par_term)  # 7 * 5 / 4
-        prod_term = Group(prod_term)("product")
-
-        sum_term = Optional(plus_minus) + prod_term + ZeroOrMore(plus_minus + prod_term)  # -5 + 4 - 3
-        sum_term = Group(sum_term)("sum")
-
-        # Finish the recursion.
-        expr << sum_term  # pylint: disable=W0104
-        self.tree = (expr + stringEnd).parseString(self.math_expr)[0]
+        Store a `(name, children)` tuple tree in `self.tree` with proper
+        groupings to reflect parenthesis and order of operations. Leave all
+        operators in the tree and do not parse any strings of numbers into
+        their float versions. Populate `variables_used`/`functions_used` as
+        names are encountered.
+        """
+        self.tree = _parse_tree(self.math_expr, self.variables_used, self.functions_used)
+        if self.case_sensitive:
+            self.variables_used_norm = self.variables_used
+            self.functions_used_norm = self.functions_used
+        else:
+            self.variables_used_norm = {v.lower() for v in self.variables_used}
+            self.functions_used_norm = {f.lower() for f in self.functions_used}
 
     def reduce_tree(self, handle_actions, terminal_converter=None):
         """
@@ -488,30 +878,37 @@ class ParseAugmenter(object):
         `terminal_converter` is a function that takes in a token and returns a
         processed form. The default of `None` just leaves them as strings.
         """
-        def handle_node(node):
-            """
-            Return the result representing the node, using recursion.
-
-            Call the appropriate `handle_action` for this node. As its inputs,
-            feed it the output of `handle_node` for each child node.
-            """
-            if not isinstance(node, ParseResults):
+        # Iterative post-order traversal: no Python frame per node, and no
+        # RecursionError on deeply nested expressions. Each branch node is
+        # pushed twice; the second visit folds its children's results (the
+        # last len(children) entries of `results`) through its action.
+        stack = [(self.tree, False)]
+        results = []
+        while stack:
+            node, visited = stack.pop()
+            if not isinstance(node, tuple):
                 # Then treat it as a terminal node.
                 if terminal_converter is None:
-                    return node
+                    results.append(node)
                 else:
-                    return terminal_converter(node)
-
-            node_name = node.getName()
-            if node_name not in handle_actions:  # pragma: no cover
-                raise Exception("Unknown branch name '{}'".format(node_name))
-
-            action = handle_actions[node_name]
-            handled_kids = [handle_node(k) for k in node]
-            return action(handled_kids)
+                    results.append(terminal_converter(node))
+                continue
+
+            if visited:
+                node_name = node[0]
+                if node_name not in handle_actions:  # pragma: no cover
+                    raise Exception("Unknown branch name '{}'".format(node_name))
+                nkids = len(node[1])
+                handled_kids = results[-nkids:]
+                del results[-nkids:]
+                results.append(handle_actions[node_name](handled_kids))
+            else:
+                stack.append((node, True))
+                # Reversed, so the leftmost child is handled first.
+                stack.extend((k, False) for k in reversed(node[1]))
 
-        # Find the value of the entire tree.
-        return handle_node(self.tree)
+        # The value of the entire tree.
+        return results[0]
 
     def check_variables(self, valid_variables, valid_functions):
         """
@@ -519,6 +916,14 @@ class ParseAugmenter(object):
 
         Otherwise, raise an UndefinedVariable containing all bad variables.
         """
+        if not self.variables_used and not self.functions_used:
+            return
+
+        # Fast path: one C-level subset test per set on the casified names.
+        if (self.variables_used_norm <= valid_variables.keys() and
+                self.functions_used_norm <= valid_functions.keys()):
+            return
+
         if self.case_sensitive:
             casify = lambda x: x
         else:
@@ -530,8 +935,7 @@ class ParseAugmenter(object):
         bad_vars.update(func for func in self.functions_used
                         if casify(func) not in valid_functions)
 
-        if bad_vars:
-            raise UndefinedVariable(' '.join(sorted(bad_vars)))
+        raise UndefinedVariable(' '.join(sorted(bad_vars)))
 
 #-----------------------------------------------------------------------------
 
@@ -547,6 +951,8 @@ class LatexRendered(object):
       above or below a normal height, specifically things of the form 'a^b' and
       '\frac{a}{b}'. This affects the height of wrapping parenthesis.
     """
+    __slots__ = ('latex', 'sans_parens', 'tall')
+
     def __init__(self, latex, parens=None, tall=False):
         """
         Instantiate with the latex representing the math.
@@ -629,25 +1035,21 @@ def render_number(children):
         return LatexRendered(easy_number + suffix)
 
 
+# Names rendered as latex commands: greek letters (lower and capitalized),
+# plus hbar for QM and infinity.
+_GREEK_LOWER = ("alpha beta gamma delta epsilon varepsilon zeta eta theta "
+                "vartheta iota kappa lambda mu nu xi pi rho sigma tau upsilon "
+                "phi varphi chi psi omega").split()
+_GREEK = frozenset(_GREEK_LOWER + [x.capitalize() for x in _GREEK_LOWER] +
+                   ['hbar', 'infty'])
+
+
 def enrich_varname(varname):
     """
     Prepend a backslash if we're given a greek character.
     """
-    greek = ("alpha beta gamma delta epsilon varepsilon zeta eta theta "
-             "vartheta iota kappa lambda mu nu xi pi rho sigma tau upsilon "
-             "phi varphi chi psi omega").split()
-
-    # add capital greek letters
-    greek += [x.capitalize() for x in greek]
-
-    # add hbar for QM
-    greek.append('hbar')
-
-    # add infinity
-    greek.append('infty')
-
-    if varname in greek:
-        return r"\{letter}".format(letter=varname)
+    if varname in _GREEK:
+        return "\\" + varname
     else:
         return varname.replace("_", r"\_")
 
@@ -733,8 +1135,10 @@ def render_power(children):
     children_latex = [k.latex for k in children if k.latex != "^"]
     children_latex[-1] = children[-1].sans_parens
 
-    raise_power = lambda x, y: "{}^{{{}}}".format(y, x)
-    latex = reduce(raise_power, reversed(children_latex))
+    # Right-associative: fold the exponents from the right.
+    latex = children_latex[-1]
+    for base in reversed(children_latex[:-1]):
+        latex = "{}^{{{}}}".format(base, latex)
     return LatexRendered(latex, tall=True)
 
 
@@ -745,10 +1149,15 @@ def render_parallel(children):
     if len(children) == 1:
         return children[0]
 
-    children_latex = [k.latex for k in children if k.latex != "||"]
-    latex = r"\|".join(children_latex)
-    tall = any(k.tall for k in children)
-    return LatexRendered(latex, tall=tall)
+    children_latex = []
+    tall = False
+    for kid in children:
+        if kid.latex == "||":
+            continue
+        children_latex.append(kid.latex)
+        if kid.tall:
+            tall = True
+    return LatexRendered(r"\|".join(children_latex), tall=tall)
 
 
 def render_frac(numerator, denominator):
@@ -790,11 +1199,14 @@ def render_product(children):
 
     position = "numerator"  # or denominator
     fraction_mode_ever = False
+    tall = False
     numerator = []
     denominator = []
     latex = ""
 
     for kid in children:
+        if kid.tall:
+            tall = True
         if position == "numerator":
             if kid.latex == "*":
                 pass  # Don't explicitly add the '\cdot' yet.
@@ -827,8 +1239,7 @@ def render_product(children):
         num_latex = r"\cdot ".join(k.latex for k in numerator)
         latex += num_latex
 
-    tall = fraction_mode_ever or any(k.tall for k in children)
-    return LatexRendered(latex, tall=tall)
+    return LatexRendered(latex, tall=fraction_mode_ever or tall)
 
 
 def render_sum(children):
@@ -838,10 +1249,13 @@ def render_sum(children):
     if len(children) == 1:
         return children[0]
 
-    children_latex = [k.latex for k in children]
-    latex = "".join(children_latex)
-    tall = any(k.tall for k in children)
-    return LatexRendered(latex, tall=tall)
+    children_latex = []
+    tall = False
+    for kid in children:
+        children_latex.append(kid.latex)
+        if kid.tall:
+            tall = True
+    return LatexRendered("".join(children_latex), tall=tall)
 
 
 def render_atom(children):
@@ -858,11 +1272,12 @@ def render_atom(children):
         return children[0]
 
 
-def add_defaults(var, fun, case_sensitive=False):
+def add_default_names(var, fun, case_sensitive=False):
     """
-    Create sets with both the default and user-defined variables.
+    Create sets with both the default and user-defined variable names.
 
-    Compare to calc.add_defaults
+    Compare to `add_defaults`, which returns dictionaries of values for
+    evaluation; here only the names matter (for rendering).
     """
     var_items = set(DEFAULT_VARIABLES)
     fun_items = set(DEFAULT_FUNCTIONS)
@@ -887,12 +1302,11 @@ def latex_preview(math_expr, variables=(), functions=(), case_sensitive=False):
     if math_expr.strip() == "":
         return ""
 
-    # Parse tree
-    latex_interpreter = ParseAugmenter(math_expr, case_sensitive)
-    latex_interpreter.parse_algebra()
+    # Parse tree (memoized)
+    latex_interpreter = _parse_cached(math_expr, case_sensitive)
 
     # Get our variables together.
-    variables, functions = add_defaults(variables, functions, case_sensitive)
+    variables, functions = add_default_names(variables, functions, case_sensitive)
 
     # Create a recursion to evaluate the tree.
     if case_sensitive:
@@ -3,10 +3,12 @@
 import os
 import re
 import sys
-import codecs
+import glob
+import shutil
+import subprocess
 import hashlib
 import argparse
-import subprocess
+from xml.sax.saxutils import escape
 from path import Path as path
 from lxml import etree
 from latex2edx.plastexit import plastex2xhtml
@@ -16,7 +18,70 @@ from .abox import split_args_with_quoted_strings
 
 # -----------------------------------------------------------------------------
 
+_QUESTION_ATTRIB_RE = re.compile(r'<question (pythonic|multiplechoice|drag_and_drop|bigbox)="1".*?>')
+_Q_OPEN_RE = re.compile(r"(<question [^>]+?>)")
+_VALID_QNAME_RE = re.compile(r"^[A-Za-z][_A-Za-z0-9]*$")
+_DECIMAL_CHARREF_RE = re.compile(r'&#(\d+);')
+
+_PKG_DIR = os.path.dirname(os.path.abspath(__file__))
+_SYSLIB_DIR = os.path.join(_PKG_DIR, "lib")
+
+with open(os.path.join(_SYSLIB_DIR, "preload_code.py")) as _fp:
+    _PRELOAD_CODE_TEMPLATE = _fp.read()
+
+_EXPLANATION_KEY_RE = re.compile(r'\[key:([0-9a-f]{20})\]')
+
+# parsers are reusable (single-threaded here); constructing one per parse
+# repeats libxml2's SAX handler setup for no benefit
+_XML_PARSER = etree.XMLParser(strip_cdata=False, huge_tree=True)
+_PP_XML_PARSER = etree.XMLParser(strip_cdata=False, remove_blank_text=True, huge_tree=True)
+
+_MATH_RE = re.compile(r'\[(/?mathjax(?:inline)?)\]')
+_MATH_MAP = {"mathjaxinline": "<math>",
+             "/mathjaxinline": "</math>",
+             "mathjax": "<displaymath>",
+             "/mathjax": "</displaymath>",
+}
+
+# replacement spliced in front of a dnd check function's is_formula_equal definition,
+# overloading the old formula equality test with the new sympy formula check
+_IS_FORMULA_EQUAL_OVERRIDE = ("def is_formula_equal(expected, given, samples):\n"
+                              "    ret = sympy_check.sympy_formula_check(expected, given)\n"
+                              "    return ret['ok']\n"
+                              "\n"
+                              "def old_is_formula_equal")
+
+# -----------------------------------------------------------------------------
+
 class latex2cs:
+    # pre-compiled XPath expressions, shared by all instances; compiling once
+    # skips the per-call expression parsing which find/findall do internally
+    _XP_PROBLEMS = etree.XPath(".//problem")
+    _XP_QUESTIONS = etree.XPath(".//question")
+    _XP_SOLUTIONS = etree.XPath(".//solution")
+    _XP_SCRIPTS = etree.XPath(".//script")
+    _XP_SHOWHIDE = etree.XPath(".//edxshowhide")
+    _XP_HTML = etree.XPath(".//html")
+    # superset of the questions filter_fix_inline_prompts can act on (or
+    # warn about): ones directly preceded by a <p> or styled sibling, or
+    # nested inside a <p>; the python-level checks remain authoritative
+    _XP_INLINE_PROMPT_Q = etree.XPath('.//question[preceding-sibling::*[1][self::p or @style="display:inline"] or parent::p]')
+    _XP_BIG = etree.XPath(".//big")
+    _XP_EQNARRAY = etree.XPath('.//table[@class="eqnarray"]')
+    _XP_TR = etree.XPath(".//tr")
+    _XP_TD = etree.XPath(".//td")
+    _XP_SOLUTION_HEAD = etree.XPath('.//b[text()="Solution:"]')
+    _XP_EDXINCLUDEPY = etree.XPath(".//edxincludepy")
+    _XP_EDXDNDTEX = etree.XPath(".//edxdndtex")
+    # all the tags fix_attrib_string rewrites, in one union expression
+    _XP_ATTRIB_TAGS = etree.XPath(" | ".join(".//%s" % tag for tag in
+                                             ['problem', 'chapter', 'sequential', 'vertical', 'course', 'html', 'video',
+                                              'discussion', 'edxdndtex', 'conditional', 'lti', 'split_test']))
+    # nearest enclosing scope which contains a <question> (or <problem>), used
+    # when moving solutions and hint scripts; replaces the old bounded
+    # parent-by-parent climb which re-scanned the subtree at every level
+    _XP_NEAREST_SCOPE = etree.XPath("ancestor-or-self::*[.//question or .//problem][1]")
+
     def __init__(self, fn, latex_string=None, verbose=False, extra_filters=None, add_wrap=False, lib_dir=".",
                  do_not_copy_files=False, default_npoints=1, use_sections=False):
         '''
@@ -36,32 +101,34 @@ class latex2cs:
         self.default_npoints = default_npoints
         self.extra_filters = extra_filters or []
         self.do_not_copy_files = do_not_copy_files	# used in testing
-        self.filters = [ self.filter_fix_math,
-                         self.filter_fix_math_eqnarray,
-                         self.fix_attrib_string,
-                         self.filter_fix_section_headers,
-                         self.process_dndtex,		# needs unit test
-                         self.filter_fix_solutions, 
-                         self.filter_remmove_edxinclude, 
-                         self.filter_fix_hint_definitions,
-                         self.filter_fix_inline_prompts, 
-                         self.filter_fix_question_names, 
-                         self.filter_fix_nsubmits, 
-                         self.filter_fix_ref, 
-                         self.process_video, 
-                         self.filter_remove_discussion, 
-                         self.process_edxxml,		# needs unit test
-                         self.process_includepy,
-                         self.process_showhide,
-                         self.pp_xml,			# next-to-next-to-last: pretty prints XML into string
-                         self.filter_fix_question,	# must be next-to-last, because the result is not XML strict
-                         self.add_explanations,
+        self._preload_cache = None			# in-memory copy of preload.py contents
+        # each filter is annotated with the representation it takes: "xml"
+        # filters receive (and keep working on) the shared etree, "str"
+        # filters receive the serialized document; convert only round-trips
+        # through libxml2 on transitions between the two kinds
+        self.filters = [ (self.filter_fix_math, "str"),
+                         (self.filter_fix_math_eqnarray, "xml"),
+                         (self.fix_attrib_string, "xml"),
+                         (self.filter_fix_section_headers, "xml"),
+                         (self.process_dndtex, "xml"),		# needs unit test
+                         (self.filter_fix_solutions, "xml"),
+                         (self.filter_remmove_edxinclude, "xml"),
+                         (self.filter_fix_hint_definitions, "xml"),
+                         (self.filter_fix_inline_prompts, "xml"),
+                         (self.filter_fix_question_names, "xml"),
+                         (self.filter_fix_nsubmits, "xml"),
+                         (self.filter_fix_simple_tags, "xml"),	# ref, video, discussion, edxxml in one traversal
+                         (self.process_includepy, "xml"),
+                         (self.process_showhide, "xml"),
+                         (self.pp_xml, "xml"),		# next-to-next-to-last: pretty prints XML into string
+                         (self.filter_fix_question, "str"),	# must be next-to-last, because the result is not XML strict
+                         (self.add_explanations, "str"),
         ]
-        self.filters += self.extra_filters
+        self.filters += [(ffn, "str") for ffn in self.extra_filters]
         self.explanations = {}				# csq_explanations are added at the end, after pretty printing, to preserve pp
         self.showhide_installed = False
         self.general_hint_system_installed = False	# if hints are used, the supporting python scripts must be in the library, and be imported
-        self.question_names = []			# used to make sure all question names are globally unique
+        self.question_names = set()			# used to make sure all question names are globally unique
 
     def convert(self, ofn=None, skip_output=False):
         imdir = "__STATIC__"
@@ -86,15 +153,21 @@ class latex2cs:
         self.xhtml = self.p2x.xhtml
         xhtml = self.xhtml
 
-        for ffn in self.filters:
+        for ffn, kind in self.filters:
+            if kind == "xml" and isinstance(xhtml, str):
+                xhtml = self.str2xml(xhtml)
+            elif kind == "str" and not isinstance(xhtml, str):
+                xhtml = etree.tostring(xhtml, encoding="unicode")
             xhtml = ffn(xhtml)
+        if not isinstance(xhtml, str):
+            xhtml = etree.tostring(xhtml, encoding="unicode")
 
         if skip_output:
             return xhtml
 
         if ofn:
-            with codecs.open(ofn, 'w', encoding="utf8") as ofp:
-                ofp.write(xhtml)
+            with open(ofn, 'wb') as ofp:
+                ofp.write(xhtml.encode("utf8"))
                 print("Wrote %s" % ofn)
 
     def str2xml(self, xmlstr):
@@ -102,9 +175,7 @@ class latex2cs:
         Convert xmlstr to xml in etree representation, without lossing CDATA sections
         Returns xml tree.
         '''
-        parser = etree.XMLParser(strip_cdata=False)
-        tree = etree.fromstring(xmlstr, parser=parser)
-        return tree
+        return etree.fromstring(xmlstr, parser=_XML_PARSER)
 
     def pp_xml(self, xml):
         '''
@@ -114,88 +185,89 @@ class latex2cs:
 
         Returns string
         '''
-        # os.popen('xmllint --format -o tmp.xml -','w').write(etree.tostring(xml))
-        try:
-            p = subprocess.Popen(['xmllint', '--format', '-o', 'tmp.xml', '-'], stdin=subprocess.PIPE)
-            if isinstance(xml, str):
-                xml = xml.encode("utf8")
-            if not isinstance(xml, bytes):
-                xml = etree.tostring(xml)
-                if self.verbose > 2:
-                    print("[latex2cs] ran tostring on xml, producing type %s" % type(xml))
-            # print("xml has type %s" % type(xml))
-            p.stdin.write(xml)
-            p.stdin.close()
-            p.wait()
-            with codecs.open('tmp.xml', encoding="utf8") as xfp:
-                xml = xfp.read()
+        if not isinstance(xml, (str, bytes)):
+            # work on a copy, sans tail, so the live tree isn't re-indented
+            xml = etree.tostring(xml, with_tail=False)
+        if isinstance(xml, str):
             xml = xml.encode("utf8")
-        except Exception as err:
-            print("[xbundle.py] Warning - no xmllint")
-            print(err)
-            xml = etree.tostring(xml, pretty_print=True)
-
-        xml = xml.decode("utf8")
-        if xml.startswith('<?xml '):
-            xml = xml.split('\n', 1)[1]
+        # dropping blank text at parse + pretty_print reproduces what piping
+        # through xmllint --format did
+        xml = etree.tostring(etree.fromstring(xml, parser=_PP_XML_PARSER), pretty_print=True)
+        # default (ASCII) serialization gives character references for
+        # non-ascii, as xmllint did; xmllint wrote them in hex
+        xml = _DECIMAL_CHARREF_RE.sub(lambda m: "&#x%X;" % int(m.group(1)), xml.decode("utf8"))
         return xml
 
+    @staticmethod
+    def _question_contains(question, needle):
+        '''
+        True if needle occurs in any text node of the question; streams text
+        at C level instead of serializing the subtree just for an `in` check.
+        '''
+        return any(needle in text for text in question.itertext())
+
+    @staticmethod
+    def _content_fingerprint(fn):
+        '''
+        Short hash of a file's contents, used to decide whether latex2dnd
+        outputs are stale; cheaper than rebuilding on every mtime bump.
+        '''
+        with open(fn, 'rb') as fp:
+            return hashlib.blake2b(fp.read(), digest_size=16).hexdigest()
+
+    @staticmethod
+    def _inner_xml(elem):
+        '''
+        Serialized content of elem, without the enclosing tag or its tail;
+        text is escaped the same way a full serialization would escape it.
+        '''
+        parts = [escape(elem.text)] if elem.text else []
+        parts.extend(etree.tostring(child, encoding="unicode") for child in elem)
+        return "".join(parts)
+
     @staticmethod
     def remove_parent_p(xml):
         '''
         If xml is inside an otherwise empty <p>, then push it up and remove the <p>
         '''
+        unwrap_tag = "_unwrap_"
         p = xml.getparent()
-        todrop = xml
-        where2add = xml
+        xml.tag = unwrap_tag
         if p.tag == 'p' and not p.text.strip() and len(p) == 1:	 # if in empty <p> then remove that <p>
-            todrop = p
-            where2add = p
+            p.text = None	# the <p>'s whitespace is dropped along with it, as before
+            p.tail = None
+            p.tag = unwrap_tag
             p = p.getparent()
+        # strip_tags merges text, children, and tails into place in one C call
+        etree.strip_tags(p, unwrap_tag)
 
-        # move from xml to parent: text, children, and tail
-        if xml.text:
-            if xml.getprevious() is not None:
-                if xml.getprevious().tail:
-                    xml.getprevious().tail += xml.text
-                else:
-                    xml.getprevious().tail = xml.text
-            else:
-                if p.text:
-                    p.text += xml.text
-                else:
-                    p.text = xml.text
-        for child in xml:
-            where2add.addprevious(child)
-        if xml.tail:
-            if 'child' in locals():
-                if child.tail:
-                    child.tail += xml.tail
-                else:
-                    child.tail = xml.tail
-            else:
-                if p.text:
-                    p.text += xml.tail
-                else:
-                    p.text = xml.tail
-        p.remove(todrop)
-
-    def process_edxxml(self, xhtml):
+    def filter_fix_simple_tags(self, xml):
         '''
-        move content of edXxml into body
-        If edXxml is within a <p> then drop the <p>.  This allows edXxml to be used for discussion and video.
+        Apply the independent per-tag fixes in a single traversal:
+        - change <ref> to <b> (used by equation references; catsoop looks for anchors with labels and crashes on these otherwise)
+        - replace <video> with embedded youtube
+        - remove <discussion> elements
+        - move content of edXxml into body; if edXxml is within a <p> then
+          drop the <p>, which allows edXxml to be used for discussion and video
+        The matches are collected first so mutation stays safe, preserving the
+        order the separate filters used to run in.
         '''
-        xml = self.str2xml(xhtml)
-        for edxxml in xml.findall('.//edxxml'):
-            self.remove_parent_p(edxxml)
-        return etree.tostring(xml).decode("utf8")
+        refs, videos, discussions, edxxmls = [], [], [], []
+        for elem in xml.iter():
+            tag = elem.tag
+            if tag == "ref":
+                refs.append(elem)
+            elif tag == "video":
+                videos.append(elem)
+            elif tag == "discussion":
+                discussions.append(elem)
+            elif tag == "edxxml":
+                edxxmls.append(elem)
+
+        for ref in refs:
+            ref.tag = "b"
 
-    def process_video(self, xhtml):
-        '''
-        replace video with embedded youtube
-        '''
-        xml = self.str2xml(xhtml)
-        for elem in xml.findall('.//video'):
+        for elem in videos:
             ytid = elem.get("youtube_id_1_0")
             dn = elem.get("display_name")
             elem.tag = "iframe"
@@ -207,25 +279,21 @@ class latex2cs:
             text = etree.fromstring(f"<p>{dn}</p>")
             pp = elem.getparent()
             pp.insert(pp.index(elem), text)
-        return etree.tostring(xml).decode("utf8")
 
-    def filter_remove_discussion(self, xhtml):
-        '''
-        remove <discussion> elements
-        '''
-        xml = self.str2xml(xhtml)
-        for elem in xml.findall('.//discussion'):
+        for elem in discussions:
             elem.getparent().remove(elem)
-        return etree.tostring(xml).decode("utf8")
 
-    def process_showhide(self, xhtml):
-        xml = self.str2xml(xhtml)
+        for edxxml in edxxmls:
+            self.remove_parent_p(edxxml)
+        return xml
+
+    def process_showhide(self, xml):
         n = 0
-        for sh in xml.findall(".//edxshowhide"):
+        for sh in self._XP_SHOWHIDE(xml):
             sh.tag = "div"
-            shstr = etree.tostring(sh).decode("utf8")
-            shkey = hashlib.sha224(shstr.encode("utf8")).hexdigest()[:20]
-            shkey = "showhide_%s" % shkey
+            # the id only needs to be unique within the page, so a counter
+            # suffices; no need to hash the stanza contents
+            shkey = "showhide_%08x" % n
             sh.set("id", shkey)
             sh.set("style", "border: 2px solid;border-color:blue;border-radius:10px;padding-left:10px")
             script = etree.Element("script")
@@ -237,7 +305,7 @@ class latex2cs:
             self.ensure_add_showhide(xml)
             if self.verbose:
                 print("[latex2cs] processed %d <edxshowhide> stanzas" % n)
-        return etree.tostring(xml).decode("utf8")
+        return xml
 
     def ensure_general_hint_system_installed(self):
         '''
@@ -246,28 +314,28 @@ class latex2cs:
         if self.general_hint_system_installed:
             return
         preload_fn = "preload.py"
-        syslib_dir = "%s/lib" % os.path.dirname(os.path.abspath(__file__))
-        with open("%s/preload_code.py" % syslib_dir) as fp:
-            preload_code = fp.read()
+        syslib_dir = _SYSLIB_DIR
+        preload_code = _PRELOAD_CODE_TEMPLATE
 
         userlib_cfn = "%s/calc.py" % self.lib_dir
         if not os.path.exists(userlib_cfn):
             if not self.do_not_copy_files:
-                os.system("cp %s/calc.py %s" % (syslib_dir, userlib_cfn))
+                shutil.copyfile("%s/calc.py" % syslib_dir, userlib_cfn)
             print("[latex2cs] copied calc.py to %s" % userlib_cfn)
 
         userlib_gfn = "%s/general_hint_system.py" % self.lib_dir
         if not os.path.exists(userlib_gfn):
             if not self.do_not_copy_files:
-                os.system("cp %s/general_hint_system.py %s" % (syslib_dir, userlib_gfn))
+                shutil.copyfile("%s/general_hint_system.py" % syslib_dir, userlib_gfn)
             print("[latex2cs] copied general_hint_system.py to %s" % userlib_gfn)
 
         preload_code = preload_code.format(calc=userlib_cfn, general_hint_system=userlib_gfn)
         preload = self.get_preload_py()
         if not preload_code in preload:
+            preload += preload_code
             with open(preload_fn, 'w') as prefp:
-                preload += preload_code
                 prefp.write(preload)
+            self._preload_cache = preload
             print("[latex2cs] Added code for calc and general_hint_system to preload.py")
 
         self.general_hint_system_installed = True
@@ -285,11 +353,11 @@ class latex2cs:
         doc.insert(0, script)
         self.showhide_installed = True
         sdir = "__STATIC__"
-        jsfn = "%s/lib/showhide.js" % os.path.dirname(os.path.abspath(__file__))
+        jsfn = "%s/showhide.js" % _SYSLIB_DIR
         sjsfn = "%s/%s" % (sdir, os.path.basename(jsfn))
         if not os.path.exists(sjsfn):
             if not self.do_not_copy_files:
-                os.system("cp %s %s" % (jsfn, sjsfn))
+                shutil.copyfile(jsfn, sjsfn)
             print("[latex2cs] Copied %s to %s" % (jsfn, sjsfn))
 
 
@@ -298,13 +366,15 @@ class latex2cs:
         change <question pythonic="1".*> to <question pythonic>
         xhtml should be a string
         '''
-        xhtml = re.sub('<question (pythonic|multiplechoice|drag_and_drop|bigbox)="1".*?>', r"<question \1>", xhtml)
+        xhtml = _QUESTION_ATTRIB_RE.sub(r"<question \1>", xhtml)
         return xhtml
 
     def add_to_question(self, question, new_line, replacement_key=None, at_front=False):
         '''
-        Add a new line to a <question> elment. 
-        Handle this by transforming into string, adding, and transfomring back, so
+        Add a new line to a <question> elment.
+        Plain-text content (python code lines, the usual case) is added by
+        mutating the element's text nodes in place; markup content falls back
+        to transforming into string, adding, and transfomring back, so
         that elements in the string are not misorderd or otherwise mangled.
 
         question = etree element
@@ -312,14 +382,65 @@ class latex2cs:
         replacement_key = (str) if provided, use this for the search and replace, instead of adding to end
         at_front = (bool) if true, adds new content immediately after <question ...>; default False
         '''
-        qstr = etree.tostring(question).decode("utf8")
-        if replacement_key:
-            new_qstr = qstr.replace(replacement_key, new_line)
-        else:
+        if "<" not in new_line:
+            if replacement_key:
+                changed = False
+                for elem in question.iter():
+                    if elem.text and replacement_key in elem.text:
+                        elem.text = elem.text.replace(replacement_key, new_line)
+                        changed = True
+                    if elem is not question and elem.tail and replacement_key in elem.tail:
+                        elem.tail = elem.tail.replace(replacement_key, new_line)
+                        changed = True
+                return changed
             if at_front:
-                new_qstr = re.sub("(<question [^>]+?>)", "\\1\n%s\n" % new_line, qstr)
+                if not question.attrib:		# match old regex, which required <question ...> with attributes
+                    return False
+                question.text = "\n%s\n%s" % (new_line, question.text or "")
+                return True
+            if len(question):
+                question[-1].tail = "%s%s\n" % (question[-1].tail or "", new_line)
+                return True
+            if question.text is None:	# serializes as <question/>; old string replace found no </question>
+                return False
+            question.text += "%s\n" % new_line
+            return True
+
+        if not replacement_key:
+            # markup content: parse new_line as a fragment and splice its
+            # text and children into place, instead of round-tripping the
+            # whole question through a string
+            try:
+                frag = etree.fromstring("<frag>%s\n</frag>" % new_line)
+            except Exception as err:
+                print("[latex2cs] failed to add to question, new_line=%s" % new_line)
+                raise
+            kids = list(frag)
+            if at_front:
+                if not question.attrib:	# match old regex, which required <question ...> with attributes
+                    return False
+                old_text = question.text or ""
+                question.text = "\n%s" % (frag.text or "")
+                if kids:
+                    kids[-1].tail = "%s%s" % (kids[-1].tail or "", old_text)
+                    for pos, kid in enumerate(kids):
+                        question.insert(pos, kid)
+                else:
+                    question.text += old_text
+                return True
+            if len(question):
+                question[-1].tail = "%s%s" % (question[-1].tail or "", frag.text or "")
+            elif question.text is None:	# serializes as <question/>; old string replace found no </question>
+                return False
             else:
-                new_qstr = qstr.replace("</question>", "%s\n</question>" % new_line)
+                question.text += frag.text or ""
+            question.extend(kids)
+            return True
+
+        # markup content with a replacement key: the only case still done by
+        # serializing, substituting and reparsing
+        qstr = etree.tostring(question, encoding="unicode")
+        new_qstr = qstr.replace(replacement_key, new_line)
         if new_qstr == qstr:
             return False
         try:
@@ -331,35 +452,33 @@ class latex2cs:
         question.getparent().remove(question)
         return True
         
-    def filter_remmove_edxinclude(self, xhtml):
+    def filter_remmove_edxinclude(self, xml):
         '''
         Remove <edxinclude>
         '''
-        xml = self.str2xml(xhtml)
         n = 0
-        for er in xml.findall(".//edxinclude"):
+        for er in list(xml.iter("edxinclude")):
             er.getparent().remove(er)
             n += 1
         if self.verbose:
             print("[latex2cs] removed %d <edxinclude> lines" % n)
-        return etree.tostring(xml).decode("utf8")
+        return xml
         
-    def filter_fix_math_eqnarray(self, xhtml):
+    def filter_fix_math_eqnarray(self, xml):
         '''
         Math eqnarray is turned into a table, but the width of the left-algined column is abnormally small.
         Fix this by making it wider.
         '''
-        xml = self.str2xml(xhtml)
         n = 0
-        for er in xml.findall('.//table[@class="eqnarray"]'):
-            for trow in er.findall('.//tr'):
+        for er in self._XP_EQNARRAY(xml):
+            for trow in self._XP_TR(er):
                 found_tal = False
                 tar_element = None
                 tal_element = None
                 tal_content_width = 0
                 tar_content_width = 0
                 found_tar = False
-                for ma in trow.findall('.//td'):
+                for ma in self._XP_TD(trow):
                     mas = ma.get("style")
                     if ("text-align:right" in mas) and ("vertical-align:middle" in mas):
                         tar_element = ma
@@ -421,24 +540,14 @@ class latex2cs:
                 
         if self.verbose:
             print("[latex2cs] extended width of %d <td> lines in eqnarray tables" % n)
-        return etree.tostring(xml).decode("utf8")
-
-    def filter_fix_ref(self, xhtml):
-        '''
-        change <ref> to <b> (this is used by equation references, for example; catsoop looks for anchors with labels, so it crashes on these, otherwise)
-        '''
-        xml = self.str2xml(xhtml)
-        for ref in xml.findall(".//ref"):
-            ref.tag = "b"
-        return etree.tostring(xml).decode("utf8")
+        return xml
 
-    def filter_fix_inline_prompts(self, xhtml):
+    def filter_fix_inline_prompts(self, xml):
         '''
         Move inline prompts into question as csq_prompt or csq_prompts
         '''
-        xml = self.str2xml(xhtml)
         nprompts = 0
-        for question in xml.findall(".//question"):
+        for question in self._XP_INLINE_PROMPT_Q(xml):
             prev = question.getprevious()
             if prev is None and question.getparent().tag=="p":
                 prev = question.getparent().getprevious()
@@ -446,8 +555,7 @@ class latex2cs:
                 if len(prev) and prev[0].tag=="p" and prev[0].get("style")=="display:inline":
                     prev = prev[0]
             if prev is not None and prev.tag=="p" and prev.get("style")=="display:inline":
-                prompt = etree.tostring(prev).decode("utf8")
-                prompt = prompt.split(">", 1)[1].rsplit("</", 1)[0]	# remove <p> and </p>
+                prompt = self._inner_xml(prev)	# content without the enclosing <p> and </p>
                 prev.getparent().remove(prev)
                 if question.get("multiplechoice"):
                     new_line = 'csq_prompt = r"""%s"""' % (prompt)
@@ -460,7 +568,7 @@ class latex2cs:
 
         if self.verbose:
             print("[latex2cs] moved %s prompts to their following question" % nprompts)
-        return etree.tostring(xml).decode("utf8")
+        return xml
 
     @staticmethod
     def do_attrib_string(elem):
@@ -486,35 +594,25 @@ class latex2cs:
         if 'attrib_string' in list(elem.keys()):
             elem.attrib.pop('attrib_string')  # remove attrib_string
 
-    def fix_attrib_string(self, xmlstr):
+    def fix_attrib_string(self, xml):
         '''
         Convert attrib_string in <problem>, <chapter>, etc. to attributes, intelligently.
         '''
-        TAGS = ['problem', 'chapter', 'sequential', 'vertical', 'course', 'html', 'video', 'discussion', 'edxdndtex',
-                'conditional', 'lti', 'split_test']
-        xml = self.str2xml(xmlstr)
-        for tag in TAGS:
-            for elem in xml.findall('.//%s' % tag):
-                self.do_attrib_string(elem)
-        return etree.tostring(xml).decode("utf8")
+        for elem in self._XP_ATTRIB_TAGS(xml):
+            self.do_attrib_string(elem)
+        return xml
 
 
-    def filter_fix_nsubmits(self, xhtml):
+    def filter_fix_nsubmits(self, xml):
         '''
         If max number of attempts (csq_nsubmits) is not specified, then inherit it from the enclosing <problem>
         '''
-        xml = self.str2xml(xhtml)
         n = 0
-        for question in xml.findall(".//question"):
-            if "csq_nsubmits" in etree.tostring(question).decode("utf8"):
+        for question in self._XP_QUESTIONS(xml):
+            if self._question_contains(question, "csq_nsubmits"):
                 continue
-            parent = question.getparent()
-            cnt = 0
-            while parent and (not parent.tag=="problem") and cnt < 10:
-                parent = parent.getparent()
-                cnt += 1
-            problem = parent
-            if not parent:
+            problem = next(question.iterancestors("problem"), None)
+            if problem is None:
                 print("[latex2cs] warning - question %s not within a <problem>" % question)
                 continue
             attempts = problem.get("attempts")
@@ -532,7 +630,7 @@ class latex2cs:
         
         if n and self.verbose:
             print("[latex2cs] fixed %d questions to have csq_nsubmits defined" % n)
-        return etree.tostring(xml).decode("utf8")
+        return xml
 
 
     def make_valid_question_name(self, name):
@@ -544,30 +642,28 @@ class latex2cs:
         which is different from edX's url_name criterion, which allows dashes, for example.
         Transform the question name untill acceptable, and return.
         '''
-        valid_qname = re.compile(r"^[A-Za-z][_A-Za-z0-9]*$")
-        if valid_qname.match(name):
+        if _VALID_QNAME_RE.match(name):
             return name
         name = name.replace("-", "_")
-        if valid_qname.match(name):
+        if _VALID_QNAME_RE.match(name):
             return name
         raise Exception("[latex2cs] failed to generate valid csq_name from edX url_name=%s" % name)
 
 
-    def filter_fix_question_names(self, xhtml):
+    def filter_fix_question_names(self, xml):
         '''
         If url_name is specified for a given problem, then use that to generate csq_name for any questions inside the problem
         '''
-        xml = self.str2xml(xhtml)
         n = 0
         nq = 0
-        for problem in xml.findall(".//problem"):
+        for problem in self._XP_PROBLEMS(xml):
             url_name = problem.get("url_name")
             if not url_name:
                 continue
             url_name = self.make_valid_question_name(url_name)
             qcnt = 0
-            for question in problem.findall(".//question"):
-                if "csq_name" in etree.tostring(question).decode("utf8"):
+            for question in self._XP_QUESTIONS(problem):
+                if self._question_contains(question, "csq_name"):
                     continue
                 qcnt += 1
                 csq_name = "%s_%02d" % (url_name, qcnt)
@@ -575,7 +671,7 @@ class latex2cs:
                     print("[latex2cs] Warning: question name %s already exists, but trying to add again at %s?" % (csq_name, problem))
                     while csq_name in self.question_names:
                         csq_name += "x"
-                self.question_names.append(csq_name)
+                self.question_names.add(csq_name)
                 new_line = "csq_name = '%s'" % csq_name
                 self.add_to_question(question, new_line)
             n += 1
@@ -583,20 +679,20 @@ class latex2cs:
         
         if n:
             print("[latex2cs] fixed %d problems (%s questions total) to have csq_name defined" % (n, nq))
-        return etree.tostring(xml).decode("utf8")
+        return xml
 
 
-    def filter_fix_solutions(self, xhtml):
+    def filter_fix_solutions(self, xml):
         '''
         move <solution>...</solution> into nearest csq_explanation inside <question>
         '''
-        xml = self.str2xml(xhtml)
         nmoved = 0
+        questions_by_scope = {}		# scope element -> its questions; solutions sharing a scope reuse the scan
 
-        for problem in xml.findall(".//problem"):
-            for solution in problem.findall(".//solution"):
+        for problem in self._XP_PROBLEMS(xml):
+            for solution in self._XP_SOLUTIONS(problem):
 
-                bhead = solution.xpath('.//b[text()="Solution:"]')      # remove <b>Solution:</b> and is containing <p>, if present
+                bhead = self._XP_SOLUTION_HEAD(solution)      # remove <b>Solution:</b> and is containing <p>, if present
                 if bhead:
                     bhead = bhead[0]
                     bp = bhead.getparent()
@@ -606,18 +702,21 @@ class latex2cs:
                 solution_xmlstr = self.pp_xml(solution)
                 parent = solution.getparent()
                 parent.remove(solution)
-                cnt = 0
-                while (parent.find(".//question") is None) and (cnt < 5) and (parent.find(".//problem") is None):
-                    parent = parent.getparent()
-                    cnt += 1
+                scope = self._XP_NEAREST_SCOPE(parent)
+                if scope:
+                    parent = scope[0]
+                questions = questions_by_scope.get(parent)
+                if questions is None:
+                    questions = self._XP_QUESTIONS(parent)
+                    questions_by_scope[parent] = questions
                 moved = False
-                for question in parent.findall(".//question"):
+                for question in questions:
                     if question.get("has_solution"):
                         continue
                     question.set("has_solution", "1")
 
                     qtext = 'csq_explanation=r"""\n%s"""' % solution_xmlstr
-                    qkey = hashlib.sha224(qtext.encode("utf8")).hexdigest()[:20]
+                    qkey = hashlib.blake2b(qtext.encode("utf8"), digest_size=10).hexdigest()
                     self.explanations[qkey] = qtext
                     new_line = '[key:%s]' % qkey
                     self.add_to_question(question, new_line)
@@ -629,30 +728,29 @@ class latex2cs:
 
         if self.verbose:
             print("[latex2cs] moved %s solutions to their nearest question" % nmoved)
-        return etree.tostring(xml).decode("utf8")
+        return xml
 
-    def filter_fix_hint_definitions(self, xhtml):
+    def filter_fix_hint_definitions(self, xml):
         '''
         move <script> contents where hints are defined, into nearest pythonic question
         '''
-        xml = self.str2xml(xhtml)
+        has_hint_definition = any("===HINT-DEFINITION===" in text for text in xml.itertext())
         nmoved = 0
 
-        for problem in xml.findall(".//problem"):
-            for script in problem.findall(".//script"):
+        for problem in self._XP_PROBLEMS(xml):
+            for script in self._XP_SCRIPTS(problem):
 
                 # script_xmlstr = self.pp_xml(script)
                 script_code = script.text
                 parent = script.getparent()
                 parent.remove(script)
 
-                cnt = 0
-                while (parent.find(".//question") is None) and (cnt < 5) and (parent.find(".//problem") is None):
-                    parent = parent.getparent()
-                    cnt += 1
+                scope = self._XP_NEAREST_SCOPE(parent)
+                if scope:
+                    parent = scope[0]
 
                 moved = False
-                for question in parent.findall(".//question"):
+                for question in self._XP_QUESTIONS(parent):
                     if question.get("has_script"):
                         continue
                     question.set("has_script", "1")
@@ -669,107 +767,109 @@ class latex2cs:
                 if not moved:
                     print("[latex2cs] Error!  Could not find question to move script into: %s" % script_code)
 
-        if "===HINT-DEFINITION===" in xhtml:
+        if has_hint_definition:
             self.ensure_general_hint_system_installed()
         if self.verbose:
             print("[latex2cs] moved %s scripts to their nearest question" % nmoved)
-        return etree.tostring(xml).decode("utf8")
+        return xml
 
     def add_explanations(self, xmlstr):
         '''
         Add csq_explanation assignments back in, at locations where hash keys are placed
         '''
-        for key, text in self.explanations.items():
-            xmlstr = xmlstr.replace("[key:%s]" % key, text)
-        return xmlstr
+        if not self.explanations:
+            return xmlstr
+        return _EXPLANATION_KEY_RE.sub(lambda m: self.explanations.get(m.group(1), m.group(0)), xmlstr)
 
-    def filter_fix_section_headers(self, xhtml):
+    def filter_fix_section_headers(self, xml):
         '''
         change <big> to <h2>;
         add <h3> for display_name after  <problem>
         '''
-        xml = self.str2xml(xhtml)
-        for html in xml.findall(".//html"):
-            for big in html.findall(".//big"):
+        for html in self._XP_HTML(xml):
+            for big in self._XP_BIG(html):
                 big.tag = "h2"
 
-        for prob in xml.findall(".//problem"):
+        for prob in self._XP_PROBLEMS(xml):
             if self.use_sections:
                 h3 = etree.Element("section")
             else:
                 h3 = etree.Element("h3")
             h3.text = prob.get("display_name")
             prob.insert(0, h3)
-        return etree.tostring(xml).decode("utf8")
+        return xml
 
     def filter_fix_math(self, xhtml):
         '''
         Put math into span elements with class cs_math_to_render so catsoop's katex routines know to render them as math
         '''
-        if 0:
-            xhtml = xhtml.replace("[mathjaxinline]", "\\(")
-            xhtml = xhtml.replace("[/mathjaxinline]", "\\)")
-            xhtml = xhtml.replace("[mathjax]", "\\[")
-            xhtml = xhtml.replace("[/mathjax]", "\\]")
-        elif 0:
-            xhtml = xhtml.replace("[mathjaxinline]", '<span class="cs_math_to_render cs_mathjax">')
-            xhtml = xhtml.replace("[/mathjaxinline]", "</span>")
-            xhtml = xhtml.replace("[mathjax]", '<span class="cs_math_to_render cs_mathjax">')
-            xhtml = xhtml.replace("[/mathjax]", "</span>")
-        else:
-            xhtml = xhtml.replace("[mathjaxinline]", '<math>')
-            xhtml = xhtml.replace("[/mathjaxinline]", "</math>")
-            xhtml = xhtml.replace("[mathjax]", '<displaymath>')
-            xhtml = xhtml.replace("[/mathjax]", "</displaymath>")
-        return xhtml
+        if "[mathjax" not in xhtml:	# cheap scan; skips the regex pass for math-free documents
+            return xhtml
+        return _MATH_RE.sub(lambda m: _MATH_MAP[m.group(1)], xhtml)
         
     def get_preload_py(self):
         '''
-        Read contents of preload.py and return.
+        Return contents of preload.py, reading the file only on first use;
+        the methods which write to preload.py keep the cache in sync.
         '''
-        preload_fn = "preload.py"
-        if os.path.exists(preload_fn):
-            with open(preload_fn) as fp:
-                preload = fp.read()
-            return preload
-        return ""
+        if self._preload_cache is None:
+            preload_fn = "preload.py"
+            if os.path.exists(preload_fn):
+                with open(preload_fn) as fp:
+                    self._preload_cache = fp.read()
+            else:
+                self._preload_cache = ""
+        return self._preload_cache
 
-    def process_includepy(self, xmlstr):
+    def process_includepy(self, xml):
         '''
         For line like <edxincludepy linenum="87" filename="week1_3_osr.tex">lib/ps1/check_osr2.py</edxincludepy>
         make sure the preload.py has the appropriate imports
         '''
-        xml = self.str2xml(xmlstr)
         ninc = 0
         preload_fn = "preload.py"
-        for ipy in xml.findall(".//edxincludepy"):
+        preload = self.get_preload_py()
+        existing = set(preload.splitlines())	# hashed lookup instead of substring scan per include
+        to_append = []
+        for ipy in self._XP_EDXINCLUDEPY(xml):
             pyfn = ipy.text.strip()
             mname = os.path.basename(pyfn).split(".py", 1)[0]
             inc = '%s = cs_local_python_import("%s")\n' % (mname, pyfn)
-            preload = self.get_preload_py()
-            if not inc in preload:
-                preload += "%s" % inc
-                with open(preload_fn, 'w') as prefp:
-                    prefp.write(preload)
+            if inc.rstrip("\n") not in existing:
+                existing.add(inc.rstrip("\n"))
+                to_append.append(inc)
                 ninc += 1
             else:
                 if self.verbose:
                     print("[latex2cs] include line for %s already in %s" % (pyfn, preload_fn))
             ipy.getparent().remove(ipy)
+        if to_append:
+            with open(preload_fn, 'a') as prefp:
+                prefp.write("".join(to_append))
+            self._preload_cache = preload + "".join(to_append)
         if ninc:
             print("[latex2cs] added %d python-code-include lines to %s" % (ninc, preload_fn))
 
-        return etree.tostring(xml).decode("utf8")
+        return xml
 
 
-    def process_dndtex(self, xmlstr):
+    def process_dndtex(self, xml):
         '''
         Handle \edXdndtex{dnd_file.tex} inclusion of latex2dnd tex inputs.
         The file may also be a dnd_file.dndspec
         '''
-        xml = self.str2xml(xmlstr)
-        tag = './/edxdndtex'
-        for dndxml in xml.findall(tag):
+        tag = './/edxdndtex'	# still used in error messages below
+        stat_cache = {}		# avoid re-statting files referenced by multiple edxdndtex elements
+
+        def _mtime(p):
+            if p not in stat_cache:
+                try:
+                    stat_cache[p] = os.stat(p).st_mtime
+                except OSError:
+                    stat_cache[p] = None
+            return stat_cache[p]
+
+        for dndxml in self._XP_EDXDNDTEX(xml):
             dndfn = dndxml.text
             linenum = dndxml.get('linenum', '<unavailable>')
             texfn = dndxml.get('filename', '<unavailable>')
@@ -784,7 +884,7 @@ class latex2cs:
                 print("Error: dnd file %s should be a .tex or a .dndspec file!" % dndfn)
                 print("See tex file %s line %s" % (texfn, linenum))
                 raise
-            if not os.path.exists(dndfn):
+            if _mtime(dndfn) is None:
                 print("Error: dnd tex file %s does not exist!" % dndfn)
                 print("See tex file %s line %s" % (texfn, linenum))
                 raise
@@ -810,35 +910,49 @@ class latex2cs:
             fndir = path(os.path.dirname(dndfn))
             xmlfn = fndir / (fnpre + '_dnd.xml')
 
-            run_latex2dnd = False
-            if not os.path.exists(xmlfn):
-                run_latex2dnd = True
-            if not run_latex2dnd:
-                dndmt = os.path.getmtime(dndfn)
-                xmlmt = os.path.getmtime(xmlfn)
-                if dndmt > xmlmt:
-                    run_latex2dnd = True
+            hashfn = xmlfn + '.hash'
+            fingerprint = None
+            xmlmt = _mtime(xmlfn)
+            if (xmlmt is None) or (_mtime(dndfn) > xmlmt):
+                # mtime says stale: double-check against the recorded content
+                # fingerprint, so touch / fresh checkouts don't force a rebuild
+                fingerprint = self._content_fingerprint(dndfn)
+                stored = None
+                if os.path.exists(hashfn):
+                    with open(hashfn) as hfp:
+                        stored = hfp.read().strip()
+                run_latex2dnd = (xmlmt is None) or (fingerprint != stored)
+            else:
+                run_latex2dnd = False
             if run_latex2dnd:
-                options = ''
+                argv = ['latex2dnd', '--cleanup', '-r', str(dndxml.get('resolution', 210)), '-v']
                 if dndxml.get('can_reuse', 'False').lower().strip() != 'false':
-                    options += '-C'
-                cmd = 'cd "%s"; latex2dnd --cleanup -r %s -v %s %s' % (fndir, dndxml.get('resolution', 210), options, fnb)
-                print("--> Running %s" % cmd)
+                    argv.append('-C')
+                argv.append(fnb)
+                print("--> Running %s (in %s)" % (' '.join(argv), fndir))
                 sys.stdout.flush()
-                status = os.system(cmd)
+                status = subprocess.run(argv, cwd=fndir).returncode
                 if status:
                     print("Oops - latex2dnd apparently failed - aborting!")
                     raise Exception("Oops - latex2dnd apparently failed - aborting!")
                 imdir = self.output_dir / ('__STATIC__/images/%s' % fnpre)
-                if not os.path.exists(imdir):
-                    os.system('mkdir -p %s' % imdir)
-                cmd = "cp %s/%s*.png %s/" % (fndir, fnpre, imdir)
-                print("----> Copying dnd images: %s" % cmd)
+                os.makedirs(imdir, exist_ok=True)
+                print("----> Copying dnd images %s/%s*.png to %s/" % (fndir, fnpre, imdir))
                 sys.stdout.flush()
-                status = os.system(cmd)
-                if status:
-                    print("Oops - copying images from latex2dnd apparently failed - aborting!")
+                try:
+                    npng = 0
+                    for src in glob.iglob(os.path.join(fndir, "%s*.png" % fnpre)):
+                        shutil.copyfile(src, os.path.join(imdir, os.path.basename(src)))
+                        npng += 1
+                    if not npng:
+                        raise Exception("no %s*.png images found in %s" % (fnpre, fndir))
+                except Exception as err:
+                    print("Oops - copying images from latex2dnd apparently failed (%s) - aborting!" % err)
                     raise Exception("Oops - latex2dnd apparently failed - aborting!")
+                if fingerprint is None:
+                    fingerprint = self._content_fingerprint(dndfn)
+                with open(hashfn, 'w') as hfp:
+                    hfp.write(fingerprint + "\n")
             else:
                 print("--> latex2dnd XML file %s is up to date: %s" % (xmlfn, fnpre))
 
@@ -846,12 +960,11 @@ class latex2cs:
             # Process <dndfile>_dnd.xml and create assignments
 
             dndxml.tag = 'question'
-            for k in dndxml.attrib.keys():	# remove old attributes
-                dndxml.attrib.pop(k)
+            dndxml.attrib.clear()		# remove old attributes
             dndxml.set("drag_and_drop", "1")
             dndxml.text = self.make_drag_and_drop(xmlfn, check_fn)
 
-        return etree.tostring(xml).decode("utf8")
+        return xml
 
     def make_drag_and_drop(self, xmlfn, check_fn=None):
         '''
@@ -859,19 +972,31 @@ class latex2cs:
         xmlfn = dnd XML filename
         checn_fn = check function name (if provided)
         '''
-        text = [""]
         print("Procesing drag-and-drop problem from %s" % xmlfn)
-        xml = etree.parse(xmlfn).getroot()
-        dnd_xml = etree.tostring(xml.find(".//drag_and_drop_input")).decode("utf8")
-        answer = xml.find(".//answer")
+        with open(xmlfn, 'rb') as xfp:
+            cache_key = hashlib.blake2b(xfp.read() + (check_fn or "").encode(), digest_size=16).hexdigest()
+        cachefn = "%s.qbody.%s" % (xmlfn, cache_key)
+        if os.path.exists(cachefn):	# question body unchanged since last run: skip parse + serialize
+            if self.verbose:
+                print("    using cached dnd question body %s" % cachefn)
+            with open(cachefn) as cfp:
+                return cfp.read()
+
+        found = {}		# first element seen for each tag of interest, in one streaming pass
+        for event, elem in etree.iterparse(xmlfn, events=("end",),
+                                           tag=("drag_and_drop_input", "answer", "script", "solution")):
+            if elem.tag not in found:
+                found[elem.tag] = elem
+        dnd_xml = etree.tostring(found["drag_and_drop_input"], encoding="unicode")
+        answer = found.get("answer")
 
         if check_fn is not None:
             cfn = check_fn
             print("[latex2cs.make_drag_and_drop] cfn=%s" % cfn)
-            text.append('csq_check_function = %s' % cfn)
+            cfn_line = 'csq_check_function = %s' % cfn
 
         elif answer is None:
-            script = xml.find(".//script")
+            script = found.get("script")
             cfn = script.text
             cfn += "\n"
             cfn += "ret = dnd_check_function(None, submission[0])\n"
@@ -881,28 +1006,28 @@ class latex2cs:
             cfn += "    messages = ret.get('msg')\n"
 
             # overload old formula equality testing with new sympy formula check
-            if 'def is_formula_equal' in cfn:
-                txt = "def is_formula_equal(expected, given, samples):\n"
-                txt += "    ret = sympy_check.sympy_formula_check(expected, given)\n"
-                txt += "    return ret['ok']\n\n"
-                txt += "def old_is_formula_equal"
-                cfn = cfn.replace("def is_formula_equal", txt)
+            head, sep, tail = cfn.partition("def is_formula_equal")
+            if sep:
+                cfn = head + _IS_FORMULA_EQUAL_OVERRIDE + tail
 
-            text.append('csq_check_function = r"""%s"""' % cfn)
+            cfn_line = 'csq_check_function = r"""%s"""' % cfn
 
         else:
             cfn = answer.text
-            text.append('csq_check_function = r"""%s"""' % cfn)
+            cfn_line = 'csq_check_function = r"""%s"""' % cfn
 
-        sol = xml.find(".//solution")
+        sol = found.get("solution")
         sol.tag = "span"
-        sol = etree.tostring(sol).decode("utf8")
-        sol = sol.replace('"/static/', '"CURRENT/')
+        sol_bytes = etree.tostring(sol, encoding="utf-8", xml_declaration=False)	# rewrite static paths on the raw bytes, before decoding
+        sol = sol_bytes.replace(b'"/static/', b'"CURRENT/').decode("utf-8")
         
-        text.append('csq_soln = r"""%s"""' % sol)
-        text.append('csq_dnd_xml = r"""%s"""' % dnd_xml)
-        text.append("")			# ensure empty line at end
-        return '\n'.join(text)
+        body = '\n%s\ncsq_soln = r"""%s"""\ncsq_dnd_xml = r"""%s"""\n' % (cfn_line, sol, dnd_xml)
+
+        tmpfn = cachefn + ".tmp"
+        with open(tmpfn, 'w') as cfp:
+            cfp.write(body)
+        os.replace(tmpfn, cachefn)	# atomic, so a crashed run never leaves a partial cache
+        return body
 
 #-----------------------------------------------------------------------------
 
@@ -918,9 +1043,9 @@ def CommandLine(args=None, arglist=None):
     '''
     Main command line.  Accepts args, to allow for simple unit testing.
     '''
-    import pkg_resources  # part of setuptools
+    from importlib.metadata import version as metadata_version
 
-    version = pkg_resources.require("latex2cs")[0].version
+    version = metadata_version("latex2cs")
     help_text = """usage: latex2cs [options] latex_file.tex
 
 Version: {}
@@ -192,7 +192,7 @@ test
         xhtml = l2c.convert(ofn=None, skip_output=True)
         print(xhtml)
 
-        expect = r'''<div description="Instructions for entering answer" id="showhide_2ee9cba29be94a952e3c"'''
+        expect = r'''<div description="Instructions for entering answer" id="showhide_00000000"'''
         assert expect in xhtml
 
     def test_hint1(self):